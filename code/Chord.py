@@ -1,18 +1,30 @@
 #!/usr/bin/env python3
 
-from a440_dict import freq_mapping
-from a440_dict import freq_values
 from a440_train_vector import labels
-from a440_train_vector import freqs
+from analysis import Analyzer, frame_peaks, peak_frequencies
+from chroma import chroma_frames, chroma_matrix, file_chroma, \
+                   template_classifier
+from classifier import KNearestNeighbors
+from profiling import Profile, stage
 
-from bisect import bisect_left
+import contextlib
+import functools
 import numpy as np
-import matplotlib.pyplot as plt
-import math
-import scipy.stats
-import statistics
+import os
 import sys
-import wave
+
+
+# Trained model (as written by train.py) to load at startup, if any.
+MODEL = os.environ.get('CHORD_MODEL')
+# Classifier over the trained model, or else the default training vectors
+# in a440_train_vector.
+CLASSIFIER = KNearestNeighbors.load(MODEL) if MODEL else \
+             KNearestNeighbors.from_training_vectors()
+# Classifier over the chroma templates of the same chords.
+CHROMA_CLASSIFIER = template_classifier(labels)
+# Peak detector shared by chords that are not given their own.
+ANALYZER = Analyzer(chunk=CLASSIFIER.settings.get('chunk', 2048),
+                    num_peaks=CLASSIFIER.settings.get('num_peaks', 1))
 
 
 class Chord:
@@ -26,30 +38,106 @@ class Chord:
     set is necessary to tune noise consideration parameters.
     """
 
-    def __init__(self, filename):
+    def __init__(self, source, classifier=None, cache=None, analyzer=None,
+                 features=None):
         """
-        Initalizes chord object and attempts detection as well.
+        Initalizes chord object. Detection is run the first time one of the
+        results (frequency_list, chord_prediction, chord or error) is
+        accessed.
     
-        filename : .wav file with associated music note.
-                   As for this repository, the /data/music_notes directory
-                   contains a variety of music files.
+        source     : .wav file with associated music note.
+                     As for this repository, the /data/music_notes directory
+                     contains a variety of music files. The bytes of a .wav
+                     file or an array of samples also work, see 
+                     analysis.Analyzer.
+        classifier : KNearestNeighbors over the training vectors. Defaults
+                     to the model named by $CHORD_MODEL, or else the
+                     vectors in a440_train_vector, or their chroma
+                     templates when classifying chroma.
+        cache      : Optional FeatureCache of per-chunk peaks, so files that
+                     were already analysed skip the fft.
+        analyzer   : Analyzer to detect peaks with. Defaults to one shared
+                     by every chord, unless the classifier was trained
+                     with a different chunk size or number of peaks.
+        features   : Feature vector to classify - 'peaks' for the most
+                     common peak frequencies or 'chroma' for the pitch class
+                     profile of the whole spectrum. Defaults to what the
+                     classifier was trained on.
         """
+        # Input to detect the chord of.
+        self.source = source
+        # Classifier used to label the detected features.
+        if classifier is None:
+            classifier = CHROMA_CLASSIFIER if features == 'chroma' else \
+                         CLASSIFIER
+        self.classifier = classifier
+        # Settings the classifier was trained with.
+        settings = classifier.settings
+        # Feature vector used for classification.
+        self.features = features or settings.get('features', 'peaks')
+        # Number of most common frequencies in a peaks feature vector.
+        self.num_notes = settings.get('num_notes', 3)
+        # Peak detector, holding the chunk size and window.
+        if analyzer is None:
+            chunk = settings.get('chunk', ANALYZER.chunk)
+            num_peaks = settings.get('num_peaks', ANALYZER.num_peaks)
+            if cache is None and chunk == ANALYZER.chunk and \
+               num_peaks == ANALYZER.num_peaks:
+                analyzer = ANALYZER
+            else:
+                analyzer = Analyzer(chunk=chunk, cache=cache,
+                                    num_peaks=num_peaks)
+        self.analyzer = analyzer
         # Size of sampling chunk for wav file.
-        self.chunk =  2048
-        # Waveform object of existing file.
-        self.waveform = wave.open(filename, 'rb')
-        # Sample width.
-        self.sample_width = self.waveform.getsampwidth()
-        # Frame rate.
-        self.frame_rate = self.waveform.getframerate()
-        # List of most common frequencies.
-        self.frequency_list = self.detect_frequency()
-        # Tuple such taht (Chord prediction, distance).
-        self.chord_prediction = self.detect_chord()
-        # Chord prediction string.
-        self.chord = self.chord_prediction[0]
-        # Error prediction float
-        self.error = self.chord_prediction[1]    
+        self.chunk = self.analyzer.chunk
+
+    @functools.cached_property
+    def frequency_list(self):
+        """
+        List of most common frequencies.
+        """
+        return self.detect_frequency()
+
+    @functools.cached_property
+    def chroma(self):
+        """
+        Pitch class profile of the whole waveform, as from 
+        chroma.file_chroma.
+        """
+        with self.analyzer.open(self.source) as waveform:
+            return file_chroma(waveform, self.chunk, self.analyzer.block_frames,
+                               self.analyzer.dtype, self.analyzer.workers)
+
+    @property
+    def feature_vector(self):
+        """
+        Vector the chord is classified by - the chroma or the most common
+        frequencies, depending on features.
+        """
+        if self.features == 'chroma':
+            return self.chroma
+        return self.frequency_list
+
+    @functools.cached_property
+    def chord_prediction(self):
+        """
+        Tuple such that (Chord prediction, distance).
+        """
+        return self.detect_chord()
+
+    @property
+    def chord(self):
+        """
+        Chord prediction string.
+        """
+        return self.chord_prediction[0]
+
+    @property
+    def error(self):
+        """
+        Error prediction float.
+        """
+        return self.chord_prediction[1]
 
 
     def __str__(self):
@@ -60,63 +148,99 @@ class Chord:
         return ("The chord is %s with error %.2f") % (self.chord, self.error)
 
 
-    def detect_frequency(self, num_notes=3):
+    def detect_frequency(self, num_notes=None):
         """
         Detects three most common frequencies in the chord. 
         
-        num_notes : The number of notes to detct for. Defaults to three.
+        num_notes : The number of notes to detct for. Defaults to what the
+                    classifier was trained on, or three.
 
-        Returns list of top three notes with each nested in np.ndarray.
+        Returns list of the num_notes most common frequencies, as ints in
+        Hertz (Hz), as from common_frequencies.
         """
         #### We average individual peaks to facilitate accurate extraction.
-        # Create a list of the detected frequencies.
-        frequency_list = []
-        # Create a list of integers, useful to find the mode.
-        frequency_int_list = []
-        # Incorrect value facilitates debug nicely.
-        frequency = -1
-
-        #### Set up window functions and dataset.
-        # Create a specific window for this process. Window should be 
-        # double chunk size because values are interpolated.
-        window = np.blackman(self.chunk*2)
-        # Break the data into pieces in line with this window.
-        data = self.waveform.readframes(self.chunk)
-        
-        #### Process each individual chunk.
-        # Go through the dataset chunk-by-chunk.
-        while (len(data) > self.chunk * self.sample_width) and \
-              (len(data) % self.chunk * self.sample_width == 0):
-            # Unpack dataset by piece of the sample set.
-            data_set = np.array(wave.struct.unpack('%dh' % \
-                                (len(data)/self.sample_width), data))*window
-            # Take the square of the real fft because we only care about reals.
-            fft_values = abs(np.fft.rfft(data_set))**2
-            # Find the peak and then use quadratic interpolation to pull out 
-            # the frequency unless we're just pulling out an endpiece.
-            maximum_value = fft_values[1:].argmax() + 1
-            if maximum_value != len(fft_values) - 1:
-                a, b, c = np.log(fft_values[maximum_value-1:maximum_value+2:])
-                interp = (c - a) * .5 / (2 * b - c - a)
-                frequency = ((maximum_value + interp) * self.frame_rate)/ \
-                            (self.chunk * 2)
-            else:
-                frequency = (maximum_value * self.frame_rate)/self.chunk
-            # Increment location in dataset.
-            data = self.waveform.readframes(self.chunk)
-            # It needs to exist and humans should be able to hear it.
-            if frequency > 0 and frequency < 20000:
-                frequency_list.append(frequency)
-                frequency_int_list.append(int(round(frequency)))
-        
-        #### Grab the average of the peaks.
-        chord = []
-        for i in range(num_notes):
-            frequency = scipy.stats.mode(frequency_int_list)
-            chord.append(frequency[0])
-            frequency_int_list = [x for x in frequency_int_list if x != chord[i]]
+        # Detected frequency of every chunk of the waveform.
+        frequencies = self.analyzer.peaks(self.source)
+        if num_notes is None:
+            num_notes = self.num_notes
+        with stage('aggregate'):
+            return Chord.common_frequencies(frequencies, num_notes)
+
+    @staticmethod
+    def common_frequencies(frequencies, num_notes=3):
+        """
+        Picks the most common per-chunk peak frequencies.
+
+        frequencies : np.ndarray of per-chunk peaks, as from 
+                      analysis.detect_peaks. With several peaks per chunk
+                      all of them are counted.
+        num_notes   : The number of notes to detct for. Defaults to three.
+
+        Returns list of the num_notes most common frequencies, rounded to
+        the nearest Hertz, in descending order of appearance. The list is
+        shorter when there are fewer distinct frequencies (e.g. silence).
+        """
+        # It needs to exist and humans should be able to hear it. Multiple
+        # peaks per chunk are pooled together.
+        frequencies = np.ravel(frequencies)
+        frequency_list = frequencies[(frequencies > 0) & (frequencies < 20000)]
         
-        return chord
+        #### Histogram the peaks to the nearest Hertz.
+        counts = np.bincount(np.rint(frequency_list).astype(int))
+        # Most common first. The stable sort breaks ties toward the lower
+        # frequency, as a mode does.
+        chord = np.argsort(-counts, kind='stable')[:num_notes]
+        return chord[counts[chord] > 0].tolist()
+
+    @staticmethod
+    def chunk_features(spectrum, frame_rate, chunk, features='peaks',
+                       num_peaks=1):
+        """
+        Finds the per-chunk features of a block of power spectra, for
+        classifying runs of chunks (segments of a file, or recent windows
+        of a stream) with combine_features.
+
+        spectrum   : (chunks, bins) power spectrum, as from
+                     analysis.power_spectrum.
+        frame_rate : Frame rate of the waveform - frames / second.
+        chunk      : Size of the sampling chunk.
+        features   : Either 'peaks' or 'chroma'.
+        num_peaks  : Number of peaks per chunk, as in analysis.detect_peaks.
+
+        Returns np.ndarray with the peak frequency, the strongest peaks or
+        the chroma of every chunk.
+        """
+        if features == 'chroma':
+            with stage('chroma', frames=len(spectrum)):
+                return chroma_frames(spectrum, chroma_matrix(chunk,
+                                                             frame_rate))
+        with stage('peaks', frames=len(spectrum)):
+            if num_peaks > 1:
+                return frame_peaks(spectrum, frame_rate, chunk, num_peaks)
+            return peak_frequencies(spectrum, frame_rate, chunk)
+
+    @staticmethod
+    def combine_features(rows, features='peaks', num_notes=3):
+        """
+        Combines the per-chunk features of a run of chunks into the vector
+        a classifier trained on those features compares.
+
+        rows      : np.ndarray of per-chunk features, as from
+                    chunk_features.
+        features  : Either 'peaks' or 'chroma'.
+        num_notes : Number of most common frequencies in a peaks vector.
+
+        Returns the list of most common frequencies, or the chroma summed
+        and scaled to unit length as chroma.file_chroma does. Returns None
+        if the chunks have too few distinct peaks or no chroma (e.g.
+        silence).
+        """
+        if features == 'chroma':
+            total = rows.sum(axis=0)
+            norm = np.linalg.norm(total)
+            return total / norm if norm else None
+        frequency_list = Chord.common_frequencies(rows, num_notes)
+        return frequency_list if len(frequency_list) == num_notes else None
 
     def detect_chord(self):
         """
@@ -128,42 +252,45 @@ class Chord:
         corresponding sublists that hold the dominant frequencies in 
         descending order of appearance. 
 
+        When classifying chroma, the chroma vector is matched against chord
+        templates instead.
+
         Returns tuple such that (chord name, distance from value)
         """
-        distances = {}
-        for i in range(len(labels)):
-            distances[labels[i]] = \
-                  Chord.euclidean_distance(freqs[i], self.frequency_list, len(freqs[i]))
-       
-
-        chord = min(distances.items(), key=lambda x: x[1])
-        return chord 
+        features = self.feature_vector
+        with stage('classify'):
+            return Chord.classify(features, self.classifier)
 
     @staticmethod
-    def euclidean_distance(a, b, l):
+    def classify(frequency_list, classifier=CLASSIFIER):
         """
-        Returns euclidean distance between two points in space. Exciting.
+        Finds the training chord closest to a list of frequencies.
 
-        a : First list (or other iterable) with coordinate.
-        b : Second list (or other iterable) with coordinate.
-        l : The length of the list.
+        frequency_list : Dominant frequencies in descending order of 
+                         appearance, as from common_frequencies.
+        classifier     : KNearestNeighbors to classify with. Defaults to
+                         the vectors in a440_train_vector.
 
-        Returns the euclidean distance. Thanks geometry.
+        Returns tuple such that (chord name, distance from value)
         """
-        dist = 0
-        for i in range(l):
-            dist += pow((a[i] - b[i]), 2)
-        return math.sqrt(dist)
+        return classifier.classify(np.asarray(frequency_list, dtype=float))
 
  
 def main():
     """
     Run the program, grabbing the first command line argument for the file
-    to detect the chord of and printing the prediction.
+    to detect the chord of and printing the prediction. Passing --profile
+    also prints the time spent in each stage of detection, and --chroma
+    classifies the chroma of the file rather than its peak frequencies.
     """
-    filename = sys.argv[1]
-    r = Chord(filename)
-    print(r)
+    filename = [arg for arg in sys.argv[1:] if not arg.startswith('--')][0]
+    features = 'chroma' if '--chroma' in sys.argv else None
+    profile = Profile() if '--profile' in sys.argv else None
+    with profile or contextlib.nullcontext():
+        r = Chord(filename, features=features)
+        print(r)
+    if profile:
+        print(profile, file=sys.stderr)
 
 
 if  __name__ =='__main__':
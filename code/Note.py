@@ -1,19 +1,42 @@
 #!/usr/bin/env python3
 
 from a440_dict import freq_mapping
-from a440_dict import freq_values
+from analysis import Analyzer, band_peak_frequencies, iter_peaks, \
+                     map_spectra
+from pitch_index import PitchIndex
+from profiling import Profile, stage
 
-from bisect import bisect_left
+import contextlib
+import functools
 import numpy as np
 import statistics
 import sys
-import wave
+
+
+# Index of the default note definitions, with A4 tuned to 440 Hz.
+PITCH_INDEX = PitchIndex.from_mapping(freq_mapping)
+# Peak detector shared by notes that are not given their own.
+ANALYZER = Analyzer()
+# Chunks analysed between estimates when stopping early.
+EARLY_EXIT_FRAMES = 8
+# Successive estimates that must agree before stopping early.
+EARLY_EXIT_CHECKS = 3
+# Adaptive detection refines estimates below this frequency in Hertz (Hz),
+# where a semitone is under two bins wide.
+REFINE_BELOW = 262.0
+# Multiple of the chunk size used for the refining windows.
+REFINE_FACTOR = 4
+# Power of the peak an octave down, relative to the estimate, from which
+# the estimate is taken to be a harmonic of a weak fundamental.
+SUBOCTAVE_RATIO = 0.05
+# Frequency ratio of a semitone.
+SEMITONE = 2 ** (1 / 12.)
 
 
 class Note:
     """
     Generalized note class for single musical note.
-    Assumes that A4 is tuned to 440 Hz.
+    Assumes that A4 is tuned to 440 Hz unless told otherwise.
 
     Given a wav file with the note, this program uses the fft algorithm
     for real values to evaluate the pitch class profile and match the 
@@ -23,35 +46,78 @@ class Note:
     noise across variables such as background frequencies and instruments.
     
     """
-    def __init__(self, filename):
+    def __init__(self, source, tuning=None, cache=None, analyzer=None,
+                 tolerance=None, max_frames=None, adaptive=False):
         """
-        Initalizes note object and attempts detection as well.
+        Initalizes note object. Detection is run the first time one of the
+        results (value, note, confidence or frequency) is accessed.
     
-        filename : .wav file with associated music note.
-                   As for this repository, the /data/music_notes directory
-                   contains a variety of music files.
-        """
-        #### Variables populated during value calculation. Initialized to
-        #### unlikely values to facilitate debugging.
-        # Frequency of the note. Found during value calculation.
-        self.frequency = -1
-        # Confidence in note value detection.
-        self.confidence = -1
-        # The actual note, as a string.
-        self.note = ''
-
-        ##### Existing class variables. Thanks python wave library.
-        # Waveform object of existing file.
-        self.waveform = wave.open(filename,'rb')
-        # Sample width of existing waveform - bits required / second.
-        self.sample_width = self.waveform.getsampwidth()
-        # Frame rate of existing waveform - frames / second.
-        self.frame_rate = self.waveform.getframerate()
+        source     : .wav file with associated music note.
+                     As for this repository, the /data/music_notes
+                     directory contains a variety of music files. The
+                     bytes of a .wav file or an array of samples also
+                     work, see analysis.Analyzer.
+        tuning     : Frequency of A4 in Hertz (Hz). Defaults to the notes
+                     in a440_dict, otherwise an equal tempered table is
+                     generated.
+        cache      : Optional FeatureCache of per-chunk peaks, so files
+                     that were already analysed skip the fft.
+        analyzer   : Analyzer to detect peaks with. Defaults to one shared
+                     by every note.
+        tolerance  : Stop reading the file once successive estimates give
+                     the same note with frequencies within this fraction
+                     of each other. Defaults to reading the whole file.
+        max_frames : Most chunks to analyse. Defaults to the whole file.
+        adaptive   : Whether to refine low estimates with longer windows,
+                     see refine_frequency.
+        """
+        # Input to detect the note of.
+        self.source = source
+        # Peak detector, holding the chunk size and window.
+        if analyzer is None:
+            analyzer = ANALYZER if cache is None else Analyzer(cache=cache)
+        self.analyzer = analyzer
         # Size of sampling chunk.
-        self.chunk = 2048
-        
-        #### Finally, perform note detection.
-        self.value = self.detect_note()
+        self.chunk = self.analyzer.chunk
+        # Sorted index of the note frequencies to match against.
+        self.pitch_index = PITCH_INDEX if tuning is None else \
+                           PitchIndex.for_tuning(tuning)
+        # Early exit settings.
+        self.tolerance = tolerance
+        self.max_frames = max_frames
+        # Whether low estimates are refined.
+        self.adaptive = adaptive
+        # Fraction of the chunks of the file analysed, once detected.
+        self.consumed = None
+
+    @functools.cached_property
+    def value(self):
+        """
+        Array where the first element is the note as a string and the 
+        second element is the confidence as a decimal.
+        """
+        return self.detect_note()
+
+    @property
+    def note(self):
+        """
+        The actual note, as a string.
+        """
+        return self.value[0]
+
+    @property
+    def confidence(self):
+        """
+        Confidence in note value detection.
+        """
+        return self.value[1]
+
+    @functools.cached_property
+    def frequency(self):
+        """
+        Frequency of the note, in Hertz (Hz).
+        """
+        return self.detect_frequency()
 
 
     def __str__(self):
@@ -72,9 +138,9 @@ class Note:
         """
         Returns dominant frequency of the waveform.
         
-        Takes in most setup variables, chunks up the data, and then 
-        uses real fft, chunk by chunk, to calculate frequency.
-        Then uses quadratic interpolation to pinpoint peak.
+        Frames the waveform and uses batched real ffts (see 
+        analysis.Analyzer) to find the peak of every chunk. Then uses 
+        quadratic interpolation to pinpoint peak.
 
         Returns frequency in Hertz (Hz)    
         
@@ -84,66 +150,149 @@ class Note:
         """
 
         #### We want to average the peaks to find the best possible value.
-        # Create a list of the detected frequencies.
-        frequency_list = []
-        # Create a list of integers, useful to find the mode.
-        frequency_int_list = []
-        # Incorrect value facilitates debug nicely.
-        frequency = -1
-
-        #### Set up window functions and dataset.
-        # Create a specific window for this process. Window should be 
-        # double chunk size because values are interpolated.
-        window = np.blackman(self.chunk*2)
-        # Break the data into pieces in line with this window.
-        data = self.waveform.readframes(self.chunk)
-        
-        #### Process each individual chunk.
-        # Go through the dataset chunk-by-chunk.
-        while (len(data) > self.chunk * self.sample_width) and \
-              (len(data) % self.chunk * self.sample_width == 0):
-            # Unpack dataset by piece of the sample set.
-            data_set = np.array(wave.struct.unpack('%dh' % \
-                                (len(data)/self.sample_width), data))*window
-            # Take the square of the real fft because we only care about reals.
-            fft_values = abs(np.fft.rfft(data_set))**2
-
-            # Find the peak and then use quadratic interpolation to pull out 
-            # the frequency unless we're just pulling out an endpiece.
-            maximum_value = fft_values[1:].argmax() + 1
-            if maximum_value != len(fft_values) - 1:
-                a, b, c = np.log(fft_values[maximum_value-1:maximum_value+2:])
-                interp = (c - a) * .5 / (2 * b - c - a)
-                frequency = ((maximum_value + interp) * self.frame_rate)/ \
-                            (self.chunk * 2)
-            else:
-                frequency = (maximum_value * self.frame_rate)/self.chunk
-            
-            # Increment location in dataset.
-            data = self.waveform.readframes(self.chunk)
-            if frequency > 0:
-                frequency_list.append(frequency)
-                frequency_int_list.append(int(round(frequency)))
-        
-        
-        #### Grab the average of the peaks.
-        frequency = statistics.mode(frequency_int_list)
-        float_freq = 0
-        float_freq_count = 0
-        for i in range(len(frequency_list)):
-            if frequency_int_list[i] == frequency:
-                float_freq += frequency_list[i]
-                float_freq_count += 1
-        frequency = float_freq/float_freq_count
+        if self.tolerance is not None or self.max_frames is not None:
+            frequency = self.detect_frequency_early()
+        else:
+            # Detected frequency of every chunk of the waveform.
+            frequencies = self.analyzer.peaks(self.source)
+            self.consumed = 1.0
+            with stage('aggregate'):
+                frequency = Note.dominant_frequency(frequencies)
+        if self.adaptive and 0 < frequency < REFINE_BELOW:
+            frequency = self.refine_frequency(frequency)
         
         # Double check it at least sort of worked and then return it.    
         if frequency > -1:
-            self.frequency = frequency
             return frequency
         else:
             print("Frequency calculation failed.") 
             return -1
     
+    def detect_frequency_early(self):
+        """
+        Returns dominant frequency of the waveform, reading only as much of
+        it as it takes for the estimate to settle.
+
+        Peaks are found a few chunks at a time and the estimate is updated
+        after each. Once EARLY_EXIT_CHECKS estimates in a row give the same
+        note with frequencies within the tolerance of the one before, or
+        max_frames chunks have been analysed, the rest of the file is
+        skipped. Silence before the note first sounds does not count
+        towards max_frames. Sets consumed to the fraction of the file
+        analysed.
+
+        Peaks are not cached in this mode.
+
+        Returns frequency in Hertz (Hz), or -1 if no chunk analysed had a
+        peak.
+        """
+        tolerance = 0.0 if self.tolerance is None else self.tolerance
+        with self.analyzer.open(self.source) as waveform:
+            total = len(waveform) // (self.chunk*2)
+            limit = total if self.max_frames is None else \
+                    min(total, self.max_frames)
+            frequencies = np.empty(limit)
+            used = 0
+            # Chunks of silence read before the note first sounds.
+            silent = 0
+            # Last estimate as (note, frequency) and how many agreed.
+            previous = None
+            agreed = 0
+            blocks = iter_peaks(waveform, self.chunk, EARLY_EXIT_FRAMES,
+                                dtype=self.analyzer.dtype,
+                                workers=self.analyzer.workers)
+            for _, block in blocks:
+                if not used:
+                    sounding = np.flatnonzero(block > 0)
+                    skip = sounding[0] if len(sounding) else len(block)
+                    silent += skip
+                    block = block[skip:]
+                    if not len(block):
+                        continue
+                block = block[:limit - used]
+                frequencies[used:used + len(block)] = block
+                used += len(block)
+                if used >= limit:
+                    break
+                with stage('aggregate'):
+                    try:
+                        frequency = Note.dominant_frequency(frequencies[:used])
+                    except statistics.StatisticsError:
+                        # Nothing but silence so far.
+                        previous = None
+                        continue
+                    note = self.pitch_index.match(frequency)[0]
+                if previous is not None and previous[0] == note and \
+                   abs(frequency - previous[1]) <= tolerance * previous[1]:
+                    agreed += 1
+                else:
+                    agreed = 0
+                previous = (note, frequency)
+                if agreed >= EARLY_EXIT_CHECKS - 1:
+                    break
+            blocks.close()
+
+        self.consumed = (silent + used) / float(total) if total else 1.0
+        with stage('aggregate'):
+            try:
+                return Note.dominant_frequency(frequencies[:used])
+            except statistics.StatisticsError:
+                # Nothing but silence, or max_frames of zero.
+                return -1
+
+    def refine_frequency(self, frequency):
+        """
+        Refines a low frequency estimate.
+
+        Low notes are only a bin or two apart at the normal chunk size, and
+        their fundamentals are often weaker than the second harmonic, which
+        the coarse pass then reports an octave too high. This runs a second
+        pass with REFINE_FACTOR times longer windows, so only over files
+        whose estimate is low, and looks only within a semitone of the
+        estimate and of the octave below. If the octave below holds at
+        least SUBOCTAVE_RATIO of the power, it is taken as the note.
+
+        frequency : Coarse estimate in Hertz (Hz).
+
+        Returns the refined frequency in Hertz (Hz), or the estimate if the
+        file is too short to refine.
+        """
+        chunk = self.chunk * REFINE_FACTOR
+        block_frames = max(1, self.analyzer.block_frames // REFINE_FACTOR)
+        estimate, octave_below = [], []
+        with self.analyzer.open(self.source) as waveform:
+
+            def bands(spectrum):
+                with stage('refine', frames=len(spectrum)):
+                    return [band_peak_frequencies(spectrum,
+                                                  waveform.frame_rate, chunk,
+                                                  target / SEMITONE,
+                                                  target * SEMITONE)
+                            for target in (frequency, frequency / 2)]
+
+            for _, (found, below) in map_spectra(bands, waveform, chunk,
+                                                 block_frames,
+                                                 self.analyzer.dtype,
+                                                 self.analyzer.workers):
+                estimate.append(found)
+                octave_below.append(below)
+        if not estimate:
+            return frequency
+
+        with stage('refine'):
+            frequencies, power = map(np.concatenate, zip(*estimate))
+            lower, lower_power = map(np.concatenate, zip(*octave_below))
+            sounding = power > 0
+            if not sounding.any():
+                return frequency
+            if np.median(lower_power[sounding] / power[sounding]) >= \
+               SUBOCTAVE_RATIO:
+                frequencies = lower
+            try:
+                return Note.dominant_frequency(frequencies)
+            except statistics.StatisticsError:
+                return frequency
+
     def detect_note(self):
         """
         Note detection and confidence calculation - leverages setup from 
@@ -153,30 +302,75 @@ class Note:
         and the second element is the confidence as a decimal.
         """
 
-        frequency = self.detect_frequency()
-        find_closest = lambda num,collection:min(collection,key=lambda x:abs(x-num))
-        closest_frequency = find_closest(frequency, freq_values)
-        
-        # Returns note in the form [LETTER][N OR S][OCTAVE]
-        self.note = freq_mapping[closest_frequency]
+        frequency = self.frequency
+        with stage('classify'):
+            value = Note.closest_note(frequency, self.pitch_index)
         
-        # Returns confidence based on literally just division
-        self.confidence = 100 * ( 1 - 
-                          abs((frequency - closest_frequency)/(frequency)))
+        return value
+
+    @staticmethod
+    def dominant_frequency(frequencies):
+        """
+        Averages per-chunk peak frequencies into a single frequency.
+
+        Finds the most common peak, rounded to the nearest Hertz, and
+        returns the average of the peaks that round to it.
+
+        frequencies : np.ndarray of per-chunk peaks, as from 
+                      analysis.detect_peaks. Failed (nan) peaks are ignored.
+
+        Returns frequency in Hertz (Hz).
+        """
+        # Keep the detected frequencies, dropping failed interpolations.
+        frequency_list = frequencies[frequencies > 0]
+        # Create a list of integers, useful to find the mode.
+        frequency_int_list = np.rint(frequency_list).astype(int)
         
-        # Create data structure
-        value = [self.note, self.confidence]
+        #### Grab the average of the peaks.
+        frequency = statistics.mode(frequency_int_list.tolist())
+        return frequency_list[frequency_int_list == frequency].mean()
+
+    @staticmethod
+    def closest_note(frequency, pitch_index=PITCH_INDEX):
+        """
+        Matches a frequency to the closest note.
+
+        frequency   : Frequency in Hertz (Hz).
+        pitch_index : PitchIndex of notes to match against. Defaults to
+                      the notes in a440_dict.
+
+        Returns an array where the first element is the note as a string
+        and the second element is the confidence as a decimal.
+        """
+        # Returns note in the form [LETTER][N OR S][OCTAVE] and confidence
+        # based on literally just division.
+        note, confidence = pitch_index.match(frequency)
         
-        return value
+        return [str(note), float(confidence)]
 
 def main():
     """
     Run the program, grabbing the first command line argument for the file
-    to detect the note of and printing the predicted note.
+    to detect the note of and printing the predicted note. An optional
+    second argument gives the frequency of A4 to tune to, and --profile
+    prints the time spent in each stage of detection. --early stops once
+    the estimate settles and prints how much of the file was read, and
+    --adaptive refines low notes with longer windows.
     """
-    filename = sys.argv[1]
-    r = Note(filename)
-    print(r)
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    filename = args[0]
+    tuning = float(args[1]) if len(args) > 1 else None
+    tolerance = 0.005 if '--early' in sys.argv else None
+    profile = Profile() if '--profile' in sys.argv else None
+    with profile or contextlib.nullcontext():
+        r = Note(filename, tuning, tolerance=tolerance,
+                 adaptive='--adaptive' in sys.argv)
+        print(r)
+    if tolerance is not None:
+        print("Analysed %.1f%% of the file." % (100 * r.consumed),
+              file=sys.stderr)
+    if profile:
+        print(profile, file=sys.stderr)
 
 
 if  __name__ =='__main__':
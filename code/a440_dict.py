@@ -60,7 +60,7 @@ freq_mapping = { \
     349.23 : 'FN4', \
     369.99 : 'FS4', \
     392.00 : 'GN4', \
-    415.30 : 'GS5', \
+    415.30 : 'GS4', \
     440.00 : 'AN4', \
     466.16 : 'AS4', \
     493.88 : 'BN4', \
@@ -77,7 +77,7 @@ freq_mapping = { \
     932.33 : 'AS5', \
     987.77 : 'BN5', \
     1046.50 : 'CN6', \
-    1108.76 : 'CS6', \
+    1108.73 : 'CS6', \
     1174.66 : 'DN6', \
     1244.51 : 'DS6', \
     1318.51 : 'EN6', \
@@ -99,19 +99,19 @@ freq_mapping = { \
     3322.44 : 'GS7', \
     3520.00 : 'AN7', \
     3729.31 : 'AS7', \
-    3951.07 : 'BN8', \
-    3186.01 : 'CN8', \
+    3951.07 : 'BN7', \
+    4186.01 : 'CN8', \
     4434.92 : 'CS8', \
     4698.63 : 'DN8', \
     4978.03 : 'DS8', \
     5274.04 : 'EN8', \
     5587.65 : 'FN8', \
     5919.91 : 'FS8', \
-    6271.83 : 'GN8', \
+    6271.93 : 'GN8', \
     6644.88 : 'GS8', \
     7040.00 : 'AN8', \
     7458.62 : 'AS8', \
     7902.13 : 'BN8' }
 
 
-freq_values = [16.35, 17.32, 18.35, 19.45, 20.6, 21.83, 23.12, 24.5, 25.96, 27.5, 29.14, 30.87, 32.7, 34.65, 36.71, 38.89, 41.2, 43.65, 46.25, 49.0, 51.91, 55.0, 58.27, 61.74, 65.41, 69.3, 73.42, 77.78, 82.41, 87.31, 92.5, 98.0, 103.83, 110.0, 116.54, 123.47, 130.81, 138.59, 146.83, 155.56, 164.81, 174.61, 185.0, 196.0, 207.65, 220.0, 233.08, 246.94, 261.63, 277.18, 293.66, 311.13, 329.63, 349.23, 369.99, 392.0, 415.3, 440.0, 466.16, 493.88, 523.25, 554.37, 587.33, 622.25, 659.25, 698.46, 739.99, 783.99, 830.61, 880.0, 932.33, 987.77, 1046.5, 1108.76, 1174.66, 1244.51, 1318.51, 1396.91, 1479.98, 1567.98, 1661.22, 1760.0, 1864.66, 1975.53, 2093.0, 2217.46, 2349.32, 2489.02, 2637.02, 2793.83, 2959.96, 3135.96, 3186.01, 3322.44, 3520.0, 3729.31, 3951.07, 4434.92, 4698.63, 4978.03, 5274.04, 5587.65, 5919.91, 6271.83, 6644.88, 7040.0, 7458.62, 7902.13]
+freq_values = [16.35, 17.32, 18.35, 19.45, 20.6, 21.83, 23.12, 24.5, 25.96, 27.5, 29.14, 30.87, 32.7, 34.65, 36.71, 38.89, 41.2, 43.65, 46.25, 49.0, 51.91, 55.0, 58.27, 61.74, 65.41, 69.3, 73.42, 77.78, 82.41, 87.31, 92.5, 98.0, 103.83, 110.0, 116.54, 123.47, 130.81, 138.59, 146.83, 155.56, 164.81, 174.61, 185.0, 196.0, 207.65, 220.0, 233.08, 246.94, 261.63, 277.18, 293.66, 311.13, 329.63, 349.23, 369.99, 392.0, 415.3, 440.0, 466.16, 493.88, 523.25, 554.37, 587.33, 622.25, 659.25, 698.46, 739.99, 783.99, 830.61, 880.0, 932.33, 987.77, 1046.5, 1108.73, 1174.66, 1244.51, 1318.51, 1396.91, 1479.98, 1567.98, 1661.22, 1760.0, 1864.66, 1975.53, 2093.0, 2217.46, 2349.32, 2489.02, 2637.02, 2793.83, 2959.96, 3135.96, 3322.44, 3520.0, 3729.31, 3951.07, 4186.01, 4434.92, 4698.63, 4978.03, 5274.04, 5587.65, 5919.91, 6271.93, 6644.88, 7040.0, 7458.62, 7902.13]
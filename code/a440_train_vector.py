@@ -1,6 +1,7 @@
 # Training vectors for chord recognition.
 
-# Chord labels. Be sure to add frequency vector at same index,
+# Chord labels. Be sure to add frequency vector at same index. A label may
+# appear more than once, with one frequency vector per exemplar.
 labels = ['A Major', 'B Major', 'C Major', 'D Major', 'E Major', 'F Major', 'G Major']
 
 # Vector of major frequencies present in the chord.
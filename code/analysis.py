@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+
+"""
+Shared spectral analysis for the Note and Chord classes.
+
+Rather than reading, unpacking and transforming the waveform one chunk at a
+time, the memory mapped signal is framed with strides (in the same way as
+spectrogram.stft) and transformed with a batched real fft over blocks of
+frames. Peak picking and quadratic interpolation are then done for every
+frame of a block at once.
+
+Spectra are computed in float32 by default (complex64 through the fft on
+NumPy 2), which halves the memory traffic of the batched fft. Pass
+dtype=np.float64 for full double precision.
+
+Long recordings can be split across a thread pool: each worker reads and
+transforms its own blocks of chunks straight from the memory map (the fft
+releases the GIL), and results are merged in file order. Blocks start at
+the same chunks as in the serial path, so the results are identical.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from numpy.lib import stride_tricks
+from profiling import stage
+from wav_reader import WavFile
+
+from collections import deque
+import contextlib
+import functools
+import numpy as np
+
+
+# Floating point type of windows and spectra, unless one is given.
+DTYPE = np.float32
+
+
+@functools.lru_cache(maxsize=None)
+def blackman(size, dtype=DTYPE):
+    """
+    Returns a read only Blackman window, built once per size and dtype.
+    The window's dtype sets the precision of power_spectrum.
+    """
+    window = np.blackman(size).astype(dtype)
+    window.flags.writeable = False
+    return window
+
+
+def frame_signal(samples, frame_size, hop_size=None):
+    """
+    Breaks a signal into frames without copying it.
+
+    samples    : One dimensional np.ndarray holding the signal.
+    frame_size : Number of samples in each frame.
+    hop_size   : Number of samples between frame starts. Defaults to the
+                 frame size, which gives back to back frames. Any samples
+                 left over at the end that do not fill a frame are dropped.
+
+    Returns a read only (frames, frame_size) view of the samples.
+    """
+    if hop_size is None:
+        hop_size = frame_size
+    if len(samples) < frame_size:
+        return np.zeros((0, frame_size), dtype=samples.dtype)
+    num_frames = (len(samples) - frame_size) // hop_size + 1
+    return stride_tricks.as_strided(samples,
+                                    shape=(num_frames, frame_size),
+                                    strides=(samples.strides[0]*hop_size,
+                                             samples.strides[0]),
+                                    writeable=False)
+
+
+def power_spectrum(frames, window):
+    """
+    Returns the power spectrum of every frame in one batched real fft.
+
+    frames : (frames, frame_size) array of samples.
+    window : Window of length frame_size applied to every frame. The
+             windowed frames, and so the spectrum, take its dtype.
+    """
+    windowed = np.multiply(frames, window, dtype=window.dtype)
+    return np.abs(np.fft.rfft(windowed, axis=1))**2
+
+
+def interpolate_peaks(spectrum, rows, bins, frame_rate, chunk):
+    """
+    Pinpoints peaks with quadratic interpolation on the log of the power
+    around them.
+
+    spectrum   : (frames, bins) power spectrum, as from power_spectrum.
+    rows       : Frame index of every peak, broadcastable against bins.
+    bins       : Bin index of every peak. Bins on either side must exist,
+                 except that the right one is clipped to the last bin.
+    frame_rate : Frame rate of the waveform - frames / second.
+    chunk      : Size of the sampling chunk the frames were read with.
+
+    Returns np.ndarray of frequencies in Hertz (Hz) shaped like bins, with
+    nan where the interpolation is undefined (silent bins).
+    """
+    right = np.minimum(bins + 1, spectrum.shape[1] - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a = np.log(spectrum[rows, bins - 1])
+        b = np.log(spectrum[rows, bins])
+        c = np.log(spectrum[rows, right])
+        interp = (c - a) * .5 / (2 * b - c - a)
+    return ((bins + interp) * frame_rate) / (chunk * 2)
+
+
+def peak_frequencies(spectrum, frame_rate, chunk):
+    """
+    Finds the dominant frequency of every frame of a power spectrum.
+
+    Finds the peak bin of each frame (ignoring the DC bin) and then uses
+    quadratic interpolation on the log of the power around it to pinpoint
+    the peak, unless the peak is the last bin.
+
+    spectrum   : (frames, bins) power spectrum, as from power_spectrum.
+    frame_rate : Frame rate of the waveform - frames / second.
+    chunk      : Size of the sampling chunk the frames were read with.
+
+    Returns np.ndarray with one frequency in Hertz (Hz) per frame. Frames
+    where the interpolation is undefined (silent bins) hold nan.
+    """
+    rows = np.arange(spectrum.shape[0])
+    last_bin = spectrum.shape[1] - 1
+    maximum_value = spectrum[:, 1:].argmax(axis=1) + 1
+    frequency = interpolate_peaks(spectrum, rows, maximum_value, frame_rate,
+                                  chunk)
+
+    # Endpieces cannot be interpolated.
+    endpiece = maximum_value == last_bin
+    frequency[endpiece] = (maximum_value[endpiece] * frame_rate) / chunk
+    return frequency
+
+
+def frame_peaks(spectrum, frame_rate, chunk, num_peaks=3, floor=0.1):
+    """
+    Finds the strongest few spectral peaks of every frame, so that the
+    separate notes of a chord are all picked up rather than only the
+    loudest one.
+
+    A peak is a bin at least as strong as its neighbours (the DC and last
+    bins never are), and each is interpolated as in peak_frequencies.
+
+    spectrum   : (frames, bins) power spectrum, as from power_spectrum.
+    frame_rate : Frame rate of the waveform - frames / second.
+    chunk      : Size of the sampling chunk the frames were read with.
+    num_peaks  : Number of peaks to find in each frame.
+    floor      : Peaks weaker than this fraction of the strongest bin of
+                 their frame are ignored, so that sidelobes and noise do
+                 not count as notes.
+
+    Returns (frames, num_peaks) np.ndarray of frequencies in Hertz (Hz),
+    strongest first. Frames with fewer peaks are padded with nan.
+    """
+    power = spectrum[:, 1:-1]
+    is_peak = (power > spectrum[:, :-2]) & (power >= spectrum[:, 2:]) & \
+              (power >= floor * spectrum.max(axis=1, keepdims=True))
+    scores = np.where(is_peak, power, -np.inf)
+
+    # Select the strongest candidates without sorting whole frames, then
+    # order just those.
+    num_peaks = min(num_peaks, scores.shape[1])
+    top = np.argpartition(-scores, num_peaks - 1, axis=1)[:, :num_peaks]
+    strength = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-strength, axis=1, kind='stable')
+    top = np.take_along_axis(top, order, axis=1)
+    strength = np.take_along_axis(strength, order, axis=1)
+
+    rows = np.arange(spectrum.shape[0])[:, None]
+    frequency = interpolate_peaks(spectrum, rows, top + 1, frame_rate, chunk)
+    frequency[np.isinf(strength)] = np.nan
+    return frequency
+
+
+def band_peak_frequencies(spectrum, frame_rate, chunk, low, high):
+    """
+    Finds the strongest peak of every frame within a band of frequencies,
+    interpolated as in peak_frequencies.
+
+    spectrum   : (frames, bins) power spectrum, as from power_spectrum.
+    frame_rate : Frame rate of the waveform - frames / second.
+    chunk      : Size of the sampling chunk the frames were read with.
+    low        : Lowest frequency of the band in Hertz (Hz).
+    high       : Highest frequency of the band in Hertz (Hz).
+
+    Returns a tuple of np.ndarrays with one frequency in Hertz (Hz) and one
+    power per frame.
+    """
+    bin_width = frame_rate / float(chunk * 2)
+    first = max(1, int(np.floor(low / bin_width)))
+    last = max(first, min(spectrum.shape[1] - 2, int(np.ceil(high / bin_width))))
+    rows = np.arange(spectrum.shape[0])
+    peak = spectrum[:, first:last + 1].argmax(axis=1) + first
+    return interpolate_peaks(spectrum, rows, peak, frame_rate, chunk), \
+           spectrum[rows, peak]
+
+
+def detect_peaks(waveform, chunk, block_frames=256, cache=None, num_peaks=1,
+                 dtype=DTYPE, workers=1):
+    """
+    Returns the dominant frequency of every chunk of a .wav file, or the
+    strongest few peaks of every chunk.
+
+    waveform     : WavFile, as from wav_reader. Channels stay interleaved,
+                   as in the original struct.unpack('%dh') decoding.
+    chunk        : Size of the sampling chunk. The window is double the
+                   chunk size because values are interpolated.
+    block_frames : Number of frames transformed per batched fft. Bounds
+                   the memory used, however long the file is.
+    cache        : Optional FeatureCache. When given, the peaks of files on
+                   disk are looked up by file contents and chunk size before
+                   being computed, and stored afterwards.
+    num_peaks    : Number of peaks per chunk. One gives the dominant
+                   frequency, as from peak_frequencies, and more the
+                   strongest peaks, as from frame_peaks.
+    dtype        : Floating point type of the spectra.
+    workers      : Number of threads splitting the blocks between them.
+
+    Returns np.ndarray with one frequency in Hertz (Hz) per chunk, or a
+    (chunks, num_peaks) np.ndarray for more than one peak.
+    """
+    if cache is not None and waveform.filename is not None:
+        params = {'analysis': 'peaks', 'chunk': chunk, 'window': 'blackman',
+                  'dtype': np.dtype(dtype).name}
+        # Single peak entries keep the key they had before multiple peaks.
+        if num_peaks > 1:
+            params['peaks'] = num_peaks
+        with stage('cache') as timer:
+            key = cache.key(waveform.filename, **params)
+            entry = cache.get(key)
+            timer.count(hits=int(entry is not None))
+        if entry is not None:
+            return entry['frequencies']
+        frequencies = detect_peaks(waveform, chunk, block_frames,
+                                   num_peaks=num_peaks, dtype=dtype,
+                                   workers=workers)
+        cache.put(key, frequencies=frequencies)
+        return frequencies
+
+    shape = (len(waveform) // (chunk*2),)
+    if num_peaks > 1:
+        shape += (num_peaks,)
+    frequencies = np.empty(shape)
+    for start, block in iter_peaks(waveform, chunk, block_frames, num_peaks,
+                                   dtype, workers):
+        frequencies[start:start + len(block)] = block
+    return frequencies
+
+
+def frame_seconds(waveform, chunk):
+    """
+    Returns the length in seconds of one chunk of a WavFile, i.e. the time
+    between the peaks returned by detect_peaks.
+    """
+    return chunk*2 / float(waveform.channels * waveform.frame_rate)
+
+
+def read_spectrum(waveform, window, start, stop):
+    """
+    Returns the (chunks, bins) power spectrum of chunks start to stop of a
+    .wav file, read straight from the memory map.
+
+    waveform : WavFile, as from wav_reader.
+    window   : Window of double the chunk size, as from blackman.
+    start    : Index of the first chunk.
+    stop     : Index one past the last chunk.
+    """
+    frame_size = len(window)
+    with stage('decode') as timer:
+        samples = waveform.read(start * frame_size, stop * frame_size)
+        timer.count(bytes=(stop - start) * frame_size * waveform.sample_width)
+    with stage('fft', ffts=stop - start):
+        return power_spectrum(frame_signal(samples, frame_size), window)
+
+
+def iter_spectra(waveform, chunk, block_frames=256, dtype=DTYPE):
+    """
+    Yields the power spectrum of every chunk of a .wav file, one block of
+    chunks at a time, so that only one block is held in memory.
+
+    waveform     : WavFile, as from wav_reader.
+    chunk        : Size of the sampling chunk, as in detect_peaks.
+    block_frames : Number of frames transformed per batched fft.
+    dtype        : Floating point type of the spectra.
+
+    Yields tuples of (index of the first chunk in the block, (chunks, bins)
+    power spectrum).
+    """
+    window = blackman(chunk*2, dtype)
+    num_frames = len(waveform) // len(window)
+    for start in range(0, num_frames, block_frames):
+        stop = min(start + block_frames, num_frames)
+        yield start, read_spectrum(waveform, window, start, stop)
+
+
+def map_spectra(function, waveform, chunk, block_frames=256, dtype=DTYPE,
+                workers=1):
+    """
+    Applies a function to the power spectrum of every block of chunks of a
+    .wav file, on a thread pool if there is more than one worker.
+
+    Every worker reads its own blocks from the memory map, so nothing is
+    shared but the (read only) window. Only a few blocks per worker are
+    queued ahead of the one being yielded, so memory stays bounded and a
+    caller that stops early does not wait for the rest of the file.
+
+    function     : Callable taking a (chunks, bins) power spectrum. Called
+                   from the worker threads.
+    waveform     : WavFile, as from wav_reader.
+    chunk        : Size of the sampling chunk, as in detect_peaks.
+    block_frames : Number of frames transformed per batched fft.
+    dtype        : Floating point type of the spectra.
+    workers      : Number of threads. One runs everything in the caller.
+
+    Yields tuples of (index of the first chunk in the block, result of the
+    function), in file order.
+    """
+    if workers <= 1:
+        for start, spectrum in iter_spectra(waveform, chunk, block_frames,
+                                            dtype):
+            yield start, function(spectrum)
+        return
+
+    window = blackman(chunk*2, dtype)
+    num_frames = len(waveform) // len(window)
+
+    def task(start):
+        stop = min(start + block_frames, num_frames)
+        return function(read_spectrum(waveform, window, start, stop))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        try:
+            for start in range(0, num_frames, block_frames):
+                pending.append((start, pool.submit(task, start)))
+                if len(pending) >= 2 * workers:
+                    start, future = pending.popleft()
+                    yield start, future.result()
+            while pending:
+                start, future = pending.popleft()
+                yield start, future.result()
+        finally:
+            # Stopped early; drop the blocks nobody will read.
+            for _, future in pending:
+                future.cancel()
+
+
+def iter_peaks(waveform, chunk, block_frames=256, num_peaks=1, dtype=DTYPE,
+               workers=1):
+    """
+    Yields the dominant frequency of every chunk of a .wav file, one block
+    of chunks at a time, so that only one block is held in memory.
+
+    waveform     : WavFile, as from wav_reader.
+    chunk        : Size of the sampling chunk, as in detect_peaks.
+    block_frames : Number of frames transformed per batched fft.
+    num_peaks    : Number of peaks per chunk, as in detect_peaks.
+    dtype        : Floating point type of the spectra.
+    workers      : Number of threads, as in map_spectra.
+
+    Yields tuples of (index of the first chunk in the block, np.ndarray of
+    frequencies in Hertz (Hz)).
+    """
+    def peaks(spectrum):
+        with stage('peaks', frames=len(spectrum)):
+            if num_peaks > 1:
+                return frame_peaks(spectrum, waveform.frame_rate, chunk,
+                                   num_peaks)
+            return peak_frequencies(spectrum, waveform.frame_rate, chunk)
+
+    return map_spectra(peaks, waveform, chunk, block_frames, dtype, workers)
+
+
+class Analyzer:
+    """
+    Reusable peak detector, configured once and applied to many inputs.
+
+    Inputs may be paths to .wav files, the bytes of a .wav file, arrays of
+    samples or open WavFile objects. Anything the analyzer opens itself is
+    closed again before it returns.
+    """
+    def __init__(self, chunk=2048, block_frames=256, cache=None,
+                 frame_rate=44100, channels=2, num_peaks=1, dtype=DTYPE,
+                 workers=1):
+        """
+        chunk        : Size of the sampling chunk.
+        block_frames : Number of frames transformed per batched fft.
+        cache        : Optional FeatureCache of per-chunk peaks.
+        frame_rate   : Frame rate of inputs given as bare arrays.
+        channels     : Number of interleaved channels of inputs given as
+                       bare arrays.
+        num_peaks    : Number of peaks found per chunk, as in detect_peaks.
+        dtype        : Floating point type of the spectra.
+        workers      : Number of threads each input is split between, for
+                       long recordings.
+        """
+        self.chunk = chunk
+        self.block_frames = block_frames
+        self.cache = cache
+        self.frame_rate = frame_rate
+        self.channels = channels
+        self.num_peaks = num_peaks
+        self.dtype = dtype
+        self.workers = workers
+        # Built now so that every input shares the same window.
+        self.window = blackman(chunk*2, dtype)
+
+    @contextlib.contextmanager
+    def open(self, source):
+        """
+        Opens an input as a WavFile for the duration of a with block.
+
+        source : Path, bytes of a .wav file, np.ndarray of samples or
+                 WavFile. WavFiles are left open for the caller to close.
+        """
+        if isinstance(source, WavFile):
+            yield source
+            return
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            waveform = WavFile.from_bytes(bytes(source))
+        elif isinstance(source, np.ndarray):
+            waveform = WavFile.from_array(source, self.frame_rate,
+                                          self.channels)
+        else:
+            waveform = WavFile(source)
+        with waveform:
+            yield waveform
+
+    def peaks(self, source):
+        """
+        Returns the dominant frequency (or frequencies) of every chunk of an
+        input, as from detect_peaks.
+
+        source : Path, bytes of a .wav file, np.ndarray of samples or
+                 WavFile.
+        """
+        with self.open(source) as waveform:
+            return detect_peaks(waveform, self.chunk, self.block_frames,
+                                self.cache, self.num_peaks, self.dtype,
+                                self.workers)
+
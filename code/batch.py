@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+"""
+Batch note and chord recognition over many .wav files.
+
+Spreads Note or Chord recognition for a directory, glob or manifest of
+files across a process pool, so the interpreter and the numpy and scipy
+imports are only paid for once per worker rather than once per file.
+Results are written out as JSONL or CSV in the order they complete.
+
+On slow storage, files can be read ahead on a background thread (see
+prefetch.py) and handed to the workers from memory, so reading the next
+files overlaps with analysing the current ones.
+"""
+
+from cache import FeatureCache
+from Chord import Chord
+from Note import Note
+from prefetch import Prefetcher
+from profiling import Profile
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, \
+                               as_completed, wait
+import argparse
+import contextlib
+import csv
+import glob
+import json
+import multiprocessing
+import os
+import sys
+
+
+# Output columns for each recognition kind, in CSV order.
+FIELDS = {
+    'note': ['file', 'status', 'note', 'frequency', 'confidence', 'message',
+             'profile'],
+    'chord': ['file', 'status', 'chord', 'error', 'frequencies', 'chroma',
+              'message', 'profile'],
+}
+
+
+def collect_files(sources):
+    """
+    Expands directories, glob patterns and manifests into a list of files.
+
+    sources : Iterable of strings. A directory contributes every .wav file
+              below it, a manifest (any other existing file) contributes
+              one path per line, relative to the manifest itself, and
+              anything else is treated as a glob pattern.
+
+    Returns a list of file paths in the order they were found.
+    """
+    files = []
+    for source in sources:
+        if os.path.isdir(source):
+            pattern = os.path.join(source, '**', '*.wav')
+            files.extend(sorted(glob.glob(pattern, recursive=True)))
+        elif os.path.isfile(source) and not source.endswith('.wav'):
+            base = os.path.dirname(source)
+            with open(source) as manifest:
+                for line in manifest:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        files.append(os.path.join(base, line))
+        else:
+            files.extend(sorted(glob.glob(source, recursive=True)))
+    return files
+
+
+def summarize(r):
+    """
+    Returns the recognition results of a Note or Chord as a dictionary of
+    JSON serializable fields, running detection if it has not run yet.
+    Chords give the feature vector they were classified by, either their
+    frequencies or their chroma, so no second analysis pass is run.
+    """
+    if isinstance(r, Note):
+        return {'note': r.note, 'frequency': float(r.frequency),
+                'confidence': float(r.confidence)}
+    result = {'chord': r.chord, 'error': float(r.error)}
+    if r.features == 'chroma':
+        result['chroma'] = [float(c) for c in r.chroma]
+    else:
+        result['frequencies'] = [int(f) for f in r.frequency_list]
+    return result
+
+
+def failure(filename, e):
+    """
+    Returns the result of a file that could not be recognized at all.
+    """
+    return {'file': filename, 'status': 'failed',
+            'message': '%s: %s' % (type(e).__name__, e)}
+
+
+def recognize(kind, filename, cache=None, profile=False, data=None):
+    """
+    Runs recognition on a single file. Used as the process pool task.
+
+    kind     : Either 'note' or 'chord'.
+    filename : Path to the .wav file.
+    cache    : Optional FeatureCache shared by the workers.
+    profile  : Whether to add the time spent in each stage of recognition
+               to the result, under 'profile'.
+    data     : Contents of the file, if already read. The file is then not
+               opened again.
+
+    Returns a dictionary with the fields in FIELDS[kind]. Failures are
+    reported with a status of 'failed' rather than raised, so that one
+    corrupt file does not stop the run.
+    """
+    timings = Profile() if profile else None
+    try:
+        with timings or contextlib.nullcontext():
+            recognizer = Note if kind == 'note' else Chord
+            result = {'file': filename, 'status': 'ok'}
+            source = filename if data is None else data
+            result.update(summarize(recognizer(source, cache=cache)))
+    except Exception as e:
+        result = failure(filename, e)
+    if timings:
+        result['profile'] = timings.stages
+    return result
+
+
+def run_batch(kind, files, workers=None, cache=None, profile=False,
+              prefetcher=None):
+    """
+    Recognizes every file on a process pool.
+
+    kind       : Either 'note' or 'chord'.
+    files      : List of .wav file paths.
+    workers    : Number of worker processes. Defaults to the number of CPUs.
+    cache      : Optional FeatureCache shared by the workers.
+    profile    : Whether to time the stages of recognition for every file.
+    prefetcher : Optional Prefetcher reading the files ahead. Files are
+                 then passed to the workers from memory, one per idle
+                 worker, so that the rest wait within its memory cap.
+
+    Yields one result dictionary per file, in completion order.
+    """
+    if prefetcher is not None:
+        yield from run_prefetched(kind, prefetcher, workers, cache, profile)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(recognize, kind, f, cache, profile): f
+                   for f in files}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                # The worker itself died, e.g. the pool broke.
+                yield failure(futures[future], e)
+
+
+def run_prefetched(kind, prefetcher, workers=None, cache=None, profile=False):
+    """
+    Recognizes files read ahead by a Prefetcher, as in run_batch.
+
+    The reader thread is already running, and forking a process with a
+    live thread is unsafe, so the workers are started with forkserver (or
+    spawn where that is missing) instead.
+    """
+    workers = workers or os.cpu_count() or 1
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in
+                                          methods else 'spawn')
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=context) as pool:
+        futures = {}
+
+        def finished(done):
+            for future in done:
+                filename = futures.pop(future)
+                try:
+                    yield future.result()
+                except Exception as e:
+                    yield failure(filename, e)
+
+        for filename, data in prefetcher:
+            if isinstance(data, Exception):
+                yield failure(filename, data)
+                continue
+            futures[pool.submit(recognize, kind, filename, cache, profile,
+                                data)] = filename
+            # Leave the next files in the prefetch queue until a worker is
+            # free, so they count against its memory cap.
+            if len(futures) >= workers:
+                yield from finished(wait(futures,
+                                         return_when=FIRST_COMPLETED)[0])
+        yield from finished(as_completed(list(futures)))
+
+
+def write_results(results, kind, out, output_format='jsonl'):
+    """
+    Streams results to a file object as they arrive.
+
+    results       : Iterable of result dictionaries, as from run_batch.
+    kind          : Either 'note' or 'chord'; selects the CSV columns.
+    out           : Writable text file object.
+    output_format : Either 'jsonl' or 'csv'.
+
+    Returns the number of failed files.
+    """
+    failures = 0
+    if output_format == 'csv':
+        writer = csv.DictWriter(out, fieldnames=FIELDS[kind])
+        writer.writeheader()
+    for result in results:
+        if output_format == 'csv':
+            writer.writerow({name: json.dumps(value)
+                             if isinstance(value, (list, dict)) else value
+                             for name, value in result.items()})
+        else:
+            out.write(json.dumps(result) + '\n')
+        out.flush()
+        if result['status'] != 'ok':
+            failures += 1
+    return failures
+
+
+def main():
+    """
+    Run batch recognition from the command line, writing one line per
+    file to standard output (or the given output file).
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('kind', choices=['note', 'chord'])
+    parser.add_argument('sources', nargs='+',
+                        help='directories, glob patterns or manifest files')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of worker processes')
+    parser.add_argument('-f', '--format', choices=['jsonl', 'csv'],
+                        default='jsonl')
+    parser.add_argument('-o', '--output', default=None,
+                        help='output file, defaults to standard output')
+    parser.add_argument('--cache', default=None, metavar='DIRECTORY',
+                        help='reuse analysis results cached in this directory')
+    parser.add_argument('--cache-size', type=int, default=1024,
+                        help='cache size limit in megabytes')
+    parser.add_argument('--profile', action='store_true',
+                        help='add per-stage timings to every result')
+    parser.add_argument('--prefetch', type=int, default=0, metavar='FILES',
+                        help='read up to this many files ahead of analysis')
+    parser.add_argument('--prefetch-size', type=int, default=256,
+                        help='most megabytes read ahead')
+    args = parser.parse_args()
+    if args.prefetch and args.cache:
+        # Cache keys hash the file on disk, which would read it again.
+        parser.error('--prefetch cannot be combined with --cache')
+
+    files = collect_files(args.sources)
+    cache = FeatureCache(args.cache, args.cache_size << 20) \
+            if args.cache else None
+    prefetcher = Prefetcher(files, args.prefetch, args.prefetch_size << 20) \
+                 if args.prefetch else None
+    out = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        failures = write_results(run_batch(args.kind, files, args.workers,
+                                           cache, args.profile, prefetcher),
+                                 args.kind, out, args.format)
+    finally:
+        if args.output:
+            out.close()
+        if prefetcher:
+            prefetcher.close()
+    if prefetcher:
+        metrics = prefetcher.metrics()
+        print("Prefetched %d files (%.1f MB) in %.2fs. Reader waited %.2fs "
+              "for room %d times, analysis waited %.2fs for files %d times. "
+              "Peak queue %d files, %.1f MB." %
+              (metrics['files'], metrics['bytes'] / float(1 << 20),
+               metrics['read_seconds'], metrics['reader_stall_seconds'],
+               metrics['reader_stalls'], metrics['consumer_stall_seconds'],
+               metrics['consumer_stalls'], metrics['peak_files'],
+               metrics['peak_bytes'] / float(1 << 20)), file=sys.stderr)
+    if failures:
+        print("%d of %d files failed." % (failures, len(files)),
+              file=sys.stderr)
+
+
+if  __name__ =='__main__':
+    main()
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks the note and chord recognition pipelines on the bundled data.
+
+Runs the real Note and Chord objects over the files in data/music_notes
+and data/chords under a profiling.Profile, so each stage of recognition -
+decoding, the fft, peak picking, aggregation, classification and whatever
+else the configured analyzer does - is timed as it actually ships, and
+checks the predictions against the labels encoded in the file names.
+Results are written as JSON so that runs from different versions can be
+compared.
+"""
+
+from analysis import DTYPE, Analyzer
+from batch import summarize
+from cache import FeatureCache
+from Chord import ANALYZER as CHORD_ANALYZER, CLASSIFIER, MODEL, Chord
+from Note import ANALYZER as NOTE_ANALYZER, Note
+from profiling import Profile
+from wav_reader import WavFile
+
+import argparse
+import glob
+import json
+import numpy as np
+import os
+import platform
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak memory is then not reported.
+    resource = None
+
+
+# Order stages are reported in. Stages not listed follow in the order
+# they were first seen.
+STAGES = ['cache', 'decode', 'fft', 'peaks', 'chroma', 'refine', 'aggregate',
+          'classify']
+
+# Default datasets, relative to this file.
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+DATASETS = {
+    'note': os.path.join(DATA, 'music_notes'),
+    'chord': os.path.join(DATA, 'chords', 'test'),
+}
+
+
+def expected_label(kind, filename):
+    """
+    Returns the label encoded in a bundled data file name, e.g. 'AN4' for
+    music_notes/a4_98.wav and 'A Major' for chords/test/amajor.wav.
+    """
+    name = os.path.basename(filename).split('.')[0]
+    if kind == 'note':
+        name = name.split('_')[0]
+        return name[0].upper() + 'N' + name[1:]
+    return name[0].upper() + ' ' + name[1:].capitalize()
+
+
+def make_analyzer(kind, workers=1, cache=None):
+    """
+    Returns the analyzer Note or Chord recognize with by default, or one
+    with the same settings but the given workers and cache.
+    """
+    shared = NOTE_ANALYZER if kind == 'note' else CHORD_ANALYZER
+    if workers == 1 and cache is None:
+        return shared
+    return Analyzer(chunk=shared.chunk, num_peaks=shared.num_peaks,
+                    dtype=shared.dtype, cache=cache, workers=workers)
+
+
+def ordered_stages(names):
+    """
+    Returns stage names in report order.
+    """
+    names = list(dict.fromkeys(names))
+    return [n for n in STAGES if n in names] + \
+           [n for n in names if n not in STAGES]
+
+
+def run_file(kind, filename, analyzer=None, features=None):
+    """
+    Recognizes one file with Note or Chord, timing every stage.
+
+    kind     : Either 'note' or 'chord'.
+    filename : Path to the .wav file.
+    analyzer : Analyzer to recognize with. Defaults to the one Note or
+               Chord would use.
+    features : Feature vector Chord classifies, as in Chord. Defaults to
+               what the classifier was trained on.
+
+    Returns a dictionary of the stage times in seconds, the total time,
+    the audio duration, the predicted label (None if recognition failed)
+    and the expected one.
+    """
+    result = {'file': filename, 'expected': expected_label(kind, filename),
+              'label': None}
+    with WavFile(filename) as waveform:
+        result['duration'] = waveform.nframes / float(waveform.frame_rate)
+
+    with Profile() as profile:
+        start = time.perf_counter()
+        try:
+            if kind == 'note':
+                r = Note(filename, analyzer=analyzer)
+            else:
+                r = Chord(filename, analyzer=analyzer, features=features)
+            result['label'] = summarize(r)[kind]
+        except Exception as e:
+            result['error'] = '%s: %s' % (type(e).__name__, e)
+        result['seconds'] = time.perf_counter() - start
+    result['times'] = {name: totals['seconds']
+                       for name, totals in profile.stages.items()}
+    return result
+
+
+def run_suite(kind, files, repeat=1, analyzer=None, features=None):
+    """
+    Benchmarks a pipeline over a list of files.
+
+    kind     : Either 'note' or 'chord'.
+    files    : List of .wav file paths.
+    repeat   : Number of times to run each file. The stages of the fastest
+               run are kept, to reduce noise. With a cache, that is a run
+               served from the cache.
+    analyzer : Analyzer to recognize with, as in run_file.
+    features : Feature vector chords are classified by, as in run_file.
+
+    Returns a dictionary summarizing the throughput and accuracy.
+    """
+    totals = {}
+    total = 0.0
+    duration = 0.0
+    correct = 0
+    failed = 0
+    for filename in files:
+        runs = [run_file(kind, filename, analyzer, features)
+                for _ in range(repeat)]
+        fastest = min(runs, key=lambda r: r['seconds'])
+        for stage, seconds in fastest['times'].items():
+            totals[stage] = totals.get(stage, 0.0) + seconds
+        total += fastest['seconds']
+        duration += runs[0]['duration']
+        correct += runs[0]['label'] == runs[0]['expected']
+        failed += runs[0]['label'] is None
+
+    return {
+        'files': len(files),
+        'audio_seconds': duration,
+        'stage_seconds': {n: totals[n] for n in ordered_stages(totals)},
+        'total_seconds': total,
+        'files_per_second': len(files) / total if total else None,
+        # Processing time over audio time; below one is faster than real time.
+        'realtime_factor': total / duration if duration else None,
+        'accuracy': correct / float(len(files)) if files else None,
+        'failed': failed,
+    }
+
+
+def peak_memory_mb():
+    """
+    Returns the peak resident memory of this process in megabytes.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS bytes.
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / 1024.
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Prints how a run compares to an earlier one.
+
+    results   : Results of this run, as written by main.
+    baseline  : Results of the earlier run.
+    tolerance : Fractional slowdown or accuracy loss reported as a
+                regression.
+
+    Returns the number of regressions found.
+    """
+    regressions = 0
+    for kind, suite in results['suites'].items():
+        old = baseline.get('suites', {}).get(kind)
+        if old is None:
+            continue
+        for stage in ordered_stages(suite['stage_seconds']):
+            before = old['stage_seconds'].get(stage)
+            after = suite['stage_seconds'][stage]
+            if before and after > before * (1 + tolerance):
+                print("%s %s: %.4fs -> %.4fs" % (kind, stage, before, after))
+                regressions += 1
+        if old['accuracy'] is not None and suite['accuracy'] is not None and \
+           suite['accuracy'] < old['accuracy'] - tolerance * old['accuracy']:
+            print("%s accuracy: %.3f -> %.3f" % (kind, old['accuracy'],
+                                                  suite['accuracy']))
+            regressions += 1
+    return regressions
+
+
+def check_precision(kind, files, dtype=DTYPE, tolerance=1e-4):
+    """
+    Checks that recognition with spectra of a reduced precision agrees with
+    recognition in float64.
+
+    kind      : Either 'note' or 'chord'.
+    files     : List of .wav file paths.
+    dtype     : Floating point type to check.
+    tolerance : Largest relative difference allowed in note frequencies,
+                and absolute difference in chroma. Labels, and the
+                frequencies chords are classified by, must match exactly.
+
+    Returns a list of (file, description) tuples, one per disagreement.
+    """
+    recognizer = Note if kind == 'note' else Chord
+    shared = NOTE_ANALYZER if kind == 'note' else CHORD_ANALYZER
+    # Same chunk size and peaks per chunk as the classifier was trained on.
+    analyzers = [Analyzer(chunk=shared.chunk, num_peaks=shared.num_peaks,
+                          dtype=d) for d in (np.float64, dtype)]
+    disagreements = []
+    for filename in files:
+        results = []
+        for analyzer in analyzers:
+            try:
+                results.append(summarize(recognizer(filename,
+                                                    analyzer=analyzer)))
+            except Exception as e:
+                results.append({'failed': type(e).__name__})
+        reference, reduced = results
+        if kind == 'note' and 'frequency' in reference and \
+           'frequency' in reduced:
+            difference = abs(reduced['frequency'] - reference['frequency'])
+            if difference > tolerance * abs(reference['frequency']):
+                disagreements.append((filename, 'frequency %r != %r' %
+                                      (reduced['frequency'],
+                                       reference['frequency'])))
+            # The frequency has been compared within the tolerance.
+            reference = dict(reference, frequency=None, confidence=None)
+            reduced = dict(reduced, frequency=None, confidence=None)
+        if kind == 'chord' and 'chroma' in reference and 'chroma' in reduced:
+            difference = np.max(np.abs(np.subtract(reduced['chroma'],
+                                                   reference['chroma'])))
+            if difference > tolerance:
+                disagreements.append((filename, 'chroma differs by %g' %
+                                      difference))
+            # The chroma has been compared within the tolerance.
+            reference.pop('chroma')
+            reduced.pop('chroma')
+        if kind == 'chord':
+            # The error is a distance over the (already compared) features.
+            reference.pop('error', None)
+            reduced.pop('error', None)
+        if reduced != reference:
+            disagreements.append((filename, '%r != %r' % (reduced, reference)))
+    return disagreements
+
+
+def main():
+    """
+    Run the benchmark from the command line, printing a summary and
+    optionally writing the full results to a JSON file.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('kinds', nargs='*', metavar='{note,chord}',
+                        help='pipelines to run, defaults to both')
+    parser.add_argument('--notes', default=DATASETS['note'],
+                        help='directory of note files')
+    parser.add_argument('--chords', default=DATASETS['chord'],
+                        help='directory of chord files')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('-o', '--output', default=None,
+                        help='write results to this JSON file')
+    parser.add_argument('--baseline', default=None,
+                        help='JSON results of an earlier run to compare to')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='threads each file is split between')
+    parser.add_argument('--cache', default=None, metavar='DIRECTORY',
+                        help='recognize through a feature cache here')
+    parser.add_argument('--chroma', action='store_true',
+                        help='classify chords by their chroma')
+    parser.add_argument('--check-precision', action='store_true',
+                        help='check that %s results agree with float64 '
+                             'instead of timing' % np.dtype(DTYPE).name)
+    args = parser.parse_args()
+
+    kinds = args.kinds or ['note', 'chord']
+    if not set(kinds) <= set(DATASETS):
+        parser.error('pipelines must be note or chord')
+    directories = {'note': args.notes, 'chord': args.chords}
+    if args.check_precision:
+        failures = 0
+        for kind in kinds:
+            files = sorted(glob.glob(os.path.join(directories[kind], '*.wav')))
+            disagreements = check_precision(kind, files)
+            for filename, description in disagreements:
+                print("%s: %s" % (filename, description))
+            print("%s: %d of %d files agree with float64" %
+                  (kind, len(files) - len(disagreements), len(files)))
+            failures += len(disagreements)
+        sys.exit(1 if failures else 0)
+
+    cache = FeatureCache(args.cache) if args.cache else None
+    features = 'chroma' if args.chroma else None
+    results = {'python': platform.python_version(),
+               'numpy': np.__version__,
+               'dtype': np.dtype(DTYPE).name,
+               'workers': args.workers,
+               'cache': bool(cache),
+               'features': features,
+               'model': MODEL,
+               'model_settings': CLASSIFIER.settings,
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'suites': {}}
+    for kind in kinds:
+        files = sorted(glob.glob(os.path.join(directories[kind], '*.wav')))
+        suite = run_suite(kind, files, args.repeat,
+                          make_analyzer(kind, args.workers, cache), features)
+        results['suites'][kind] = suite
+        print("%s: %d files, %.1f files/s, real-time factor %.5f, "
+              "accuracy %.3f (%d failed)" % (kind, suite['files'],
+                                             suite['files_per_second'] or 0,
+                                             suite['realtime_factor'] or 0,
+                                             suite['accuracy'] or 0,
+                                             suite['failed']))
+        for stage, seconds in suite['stage_seconds'].items():
+            print("    %-10s %.4fs" % (stage, seconds))
+    results['peak_memory_mb'] = peak_memory_mb()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            if compare(results, json.load(f)):
+                sys.exit(1)
+
+
+if  __name__ =='__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+"""
+On disk cache of per-file analysis results.
+
+Results are keyed by a hash of the file's contents together with the
+analysis parameters (chunk size, window and so on), so renaming or copying
+a file still hits the cache while changing a parameter does not. Entries
+are written atomically, so several worker processes can share one cache
+directory, and the least recently used entries are evicted once the cache
+grows past its size limit.
+"""
+
+import hashlib
+import json
+import numpy as np
+import os
+import tempfile
+import zipfile
+
+
+# Bump when the cached analysis changes, so old entries are not reused.
+CACHE_VERSION = 1
+
+
+class FeatureCache:
+    """
+    Size bounded, least recently used cache of NumPy arrays on disk.
+    """
+    def __init__(self, directory, max_bytes=1 << 30):
+        """
+        directory : Directory holding the cache. Created if needed.
+        max_bytes : Total size of entries to keep before evicting the least
+                    recently used ones.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        # Content hashes by (path, size, modification time), so a file is
+        # only hashed once per process.
+        self.hashes = {}
+
+    def __getstate__(self):
+        # Worker processes rebuild their own hash memo.
+        return {'directory': self.directory, 'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state['directory'], state['max_bytes'])
+
+    def content_hash(self, filename):
+        """
+        Returns the SHA-256 hex digest of a file's contents.
+        """
+        stat = os.stat(filename)
+        memo = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+        if memo not in self.hashes:
+            digest = hashlib.sha256()
+            with open(filename, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+            self.hashes[memo] = digest.hexdigest()
+        return self.hashes[memo]
+
+    def key(self, filename, **params):
+        """
+        Returns the cache key for a file analysed with the given parameters.
+
+        filename : Path to the analysed file.
+        params   : Analysis parameters. Values must be JSON serializable.
+        """
+        params = dict(params, version=CACHE_VERSION)
+        description = json.dumps(params, sort_keys=True)
+        digest = hashlib.sha256(description.encode()).hexdigest()[:16]
+        return '%s-%s' % (self.content_hash(filename), digest)
+
+    def path(self, key):
+        """
+        Returns the path of the file holding an entry.
+        """
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        """
+        Looks up an entry.
+
+        Returns a dictionary of arrays, or None on a miss.
+        """
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                entry = {name: data[name] for name in data.files}
+            # Mark as recently used.
+            os.utime(path)
+        except (OSError, ValueError, zipfile.BadZipFile):
+            return None
+        return entry
+
+    def put(self, key, **arrays):
+        """
+        Stores an entry, then evicts old entries if over the size limit.
+
+        key    : Cache key, as from key.
+        arrays : Named arrays to store.
+        """
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            # Atomic, so readers never see a partly written entry.
+            os.replace(temp, self.path(key))
+        except BaseException:
+            os.unlink(temp)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Removes least recently used entries until under the size limit.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npz'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                # Another worker evicted it first.
+                pass
+            total -= size
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+"""
+Chroma (pitch class profile) features.
+
+Folds the whole magnitude spectrum of every chunk into the 12 pitch classes
+with one precomputed sparse bin to pitch class matrix, so a block of chunks
+becomes a single matrix multiply. Chords are then matched against triad
+templates in the same 12 dimensional space, which does not depend on the
+octave or the instrument the way the dominant peak frequencies do.
+"""
+
+from analysis import DTYPE, map_spectra
+from classifier import KNearestNeighbors
+from pitch_index import NOTE_NAMES
+from profiling import stage
+
+import functools
+import numpy as np
+
+
+# Semitones above the root of the notes of each chord quality.
+TRIADS = {
+    'Major': [0, 4, 7],
+    'Minor': [0, 3, 7],
+}
+
+
+@functools.lru_cache(maxsize=None)
+def chroma_matrix(chunk, frame_rate, reference=440.0, fmin=100.0,
+                  fmax=2000.0):
+    """
+    Builds the sparse matrix mapping fft bins to pitch classes.
+
+    Bin frequencies use the same scale as analysis.peak_frequencies, so the
+    pitch classes line up with the notes Note reports.
+
+    chunk      : Size of the sampling chunk the spectrum was taken with.
+    frame_rate : Frame rate of the waveform - frames / second.
+    reference  : Frequency of A4 in Hertz (Hz).
+    fmin       : Lowest bin frequency to include. Low bins are wider than
+                 a semitone, so they are left out.
+    fmax       : Highest bin frequency to include.
+
+    Returns a (bins, 12) scipy.sparse.csr_matrix, with pitch class 0 as C.
+    """
+    # Only needed for chroma, so not imported with the module.
+    import scipy.sparse
+
+    bins = chunk + 1
+    frequencies = np.arange(bins) * frame_rate / float(chunk * 2)
+    used = np.flatnonzero((frequencies >= fmin) & (frequencies <= fmax))
+    # A is 9 semitones above C.
+    pitch_class = (np.rint(12 * np.log2(frequencies[used] / reference))
+                   .astype(int) + 9) % 12
+    return scipy.sparse.csr_matrix((np.ones(len(used)), (used, pitch_class)),
+                                   shape=(bins, 12))
+
+
+def chroma_frames(spectrum, matrix):
+    """
+    Folds power spectra into pitch classes.
+
+    spectrum : (chunks, bins) power spectrum, as from analysis.power_spectrum.
+    matrix   : Bin to pitch class matrix, as from chroma_matrix.
+
+    Returns (chunks, 12) np.ndarray of summed magnitudes per pitch class.
+    """
+    return np.asarray(np.sqrt(spectrum) @ matrix)
+
+
+def file_chroma(waveform, chunk, block_frames=256, dtype=DTYPE, workers=1,
+                **matrix_options):
+    """
+    Returns the chroma vector of a whole .wav file.
+
+    The chroma of every chunk is summed, so louder chunks count for more,
+    and the total is scaled to unit length.
+
+    waveform       : WavFile, as from wav_reader.
+    chunk          : Size of the sampling chunk.
+    block_frames   : Number of chunks transformed per batched fft.
+    dtype          : Floating point type of the spectra.
+    workers        : Number of threads, as in analysis.map_spectra.
+    matrix_options : Passed on to chroma_matrix.
+
+    Returns np.ndarray of 12 pitch class weights, starting from C.
+    """
+    matrix = chroma_matrix(chunk, waveform.frame_rate, **matrix_options)
+
+    def block_chroma(spectrum):
+        with stage('chroma', frames=len(spectrum)):
+            return chroma_frames(spectrum, matrix).sum(axis=0)
+
+    total = np.zeros(12)
+    # Summed in file order, so the total does not depend on the workers.
+    for _, chroma in map_spectra(block_chroma, waveform, chunk, block_frames,
+                                 dtype, workers):
+        total += chroma
+    norm = np.linalg.norm(total)
+    return total / norm if norm else total
+
+
+def chord_template(label):
+    """
+    Returns the unit length chroma template of a chord label such as
+    'A Major', 'C# Minor' or 'Bb Major'.
+
+    Raises ValueError for an accidental other than #, S or b.
+    """
+    root, quality = label.split(' ', 1)
+    accidentals = {'': 0, '#': 1, 'S': 1, 's': 1, 'b': -1}
+    if root[1:] not in accidentals:
+        raise ValueError('unknown accidental in chord %r' % label)
+    pitch_class = NOTE_NAMES.index(root[0].upper() + 'N') + \
+                  accidentals[root[1:]]
+    template = np.zeros(12)
+    template[[(pitch_class + step) % 12 for step in TRIADS[quality]]] = 1
+    return template / np.linalg.norm(template)
+
+
+def template_classifier(labels):
+    """
+    Builds a KNearestNeighbors over the chroma templates of chord labels.
+
+    labels : Iterable of chord labels. Repeats are ignored.
+    """
+    labels = list(dict.fromkeys(labels))
+    return KNearestNeighbors([chord_template(l) for l in labels], labels,
+                             settings={'features': 'chroma'})
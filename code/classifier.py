@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+"""
+K nearest neighbors classifier for chord feature vectors.
+
+The training exemplars are held in one contiguous matrix, so the distances
+to every exemplar are computed in a single broadcast rather than a Python
+loop per label. Any number of exemplars may share a label. For large
+training sets, lookups go through a KD-tree instead of the brute force
+scan.
+"""
+
+import numpy as np
+import os
+
+
+class KNearestNeighbors:
+    """
+    Labels feature vectors by majority vote of their k nearest exemplars.
+    """
+    # Training sets at least this large are searched with a KD-tree.
+    TREE_THRESHOLD = 2048
+
+    def __init__(self, features, labels, k=1, tree_threshold=TREE_THRESHOLD,
+                 settings=None):
+        """
+        features       : (exemplars, dimensions) training vectors.
+        labels         : Label of each exemplar, at the same index. Labels
+                         may repeat.
+        k              : Number of neighbors that vote on a label.
+        tree_threshold : Size of training set from which to build a
+                         KD-tree. Use None to always search brute force.
+        settings       : Dictionary of the feature extraction settings the
+                         exemplars were made with (e.g. 'features',
+                         'num_peaks'), so queries can be made to match.
+        """
+        # Contiguous training matrix, one exemplar per row.
+        self.features = np.ascontiguousarray(features, dtype=float)
+        # Labels, at the same index as their exemplar.
+        self.labels = np.asarray(labels)
+        self.k = min(k, len(self.labels))
+        self.settings = dict(settings or {})
+        self.tree = None
+        if tree_threshold is not None and len(self.labels) >= tree_threshold:
+            from scipy.spatial import cKDTree
+            self.tree = cKDTree(self.features)
+
+    @classmethod
+    def from_training_vectors(cls, **kwargs):
+        """
+        Builds a classifier from the labels and freqs in a440_train_vector.
+        """
+        from a440_train_vector import labels, freqs
+        return cls(freqs, labels, **kwargs)
+
+    @classmethod
+    def load(cls, filename, **kwargs):
+        """
+        Builds a classifier from an .npz file holding a 'features' matrix
+        and a 'labels' array, as written by save. Scalar settings are read
+        from any arrays named 'setting_<name>'.
+        """
+        prefix = 'setting_'
+        with np.load(filename) as data:
+            settings = {name[len(prefix):]: data[name].item()
+                        for name in data.files if name.startswith(prefix)}
+            return cls(data['features'], data['labels'],
+                       settings=settings, **kwargs)
+
+    def save(self, filename):
+        """
+        Writes the exemplars, labels and settings to an .npz file that
+        load reads back. The file is replaced atomically.
+        """
+        temporary = '%s.%d.tmp' % (filename, os.getpid())
+        with open(temporary, 'wb') as f:
+            np.savez(f, features=self.features,
+                     labels=self.labels.astype(str),
+                     **{'setting_' + name: value
+                        for name, value in self.settings.items()})
+        os.replace(temporary, filename)
+
+    def neighbors(self, queries):
+        """
+        Finds the k nearest exemplars of each query.
+
+        queries : (queries, dimensions) feature vectors.
+
+        Returns a tuple of (distances, indices), each (queries, k), with the
+        nearest exemplar first.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=float))
+        if self.tree is not None:
+            distances, indices = self.tree.query(queries, k=self.k)
+            return distances.reshape(len(queries), self.k), \
+                   indices.reshape(len(queries), self.k)
+
+        # Squared distances from every query to every exemplar at once.
+        difference = queries[:, np.newaxis, :] - self.features[np.newaxis, :, :]
+        distances = np.sqrt(np.einsum('qnd,qnd->qn', difference, difference))
+        if self.k == 1:
+            indices = distances.argmin(axis=1)[:, np.newaxis]
+        else:
+            indices = np.argpartition(distances, self.k - 1, axis=1)[:, :self.k]
+            order = np.take_along_axis(distances, indices, axis=1)
+            indices = np.take_along_axis(indices,
+                                         np.argsort(order, axis=1, kind='stable'),
+                                         axis=1)
+        return np.take_along_axis(distances, indices, axis=1), indices
+
+    def predict(self, queries):
+        """
+        Labels feature vectors.
+
+        queries : (queries, dimensions) feature vectors.
+
+        Returns a list of (label, distance) tuples, one per query. The
+        label is the most common among the k nearest exemplars, with ties
+        going to the label of the nearest one, and the distance is to the
+        nearest exemplar with that label.
+        """
+        distances, indices = self.neighbors(queries)
+        predictions = []
+        for row_distances, row_indices in zip(distances, indices):
+            votes = self.labels[row_indices]
+            names, first, counts = np.unique(votes, return_index=True,
+                                             return_counts=True)
+            winners = np.flatnonzero(counts == counts.max())
+            winner = winners[np.argmin(first[winners])]
+            predictions.append((str(names[winner]),
+                                float(row_distances[first[winner]])))
+        return predictions
+
+    def classify(self, vector):
+        """
+        Labels a single feature vector.
+
+        Returns tuple such that (label, distance from nearest exemplar).
+        """
+        return self.predict([vector])[0]
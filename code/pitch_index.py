@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+"""
+Sorted, array backed index of note frequencies.
+
+Replaces the linear search over a440_dict.freq_values with a binary search
+(np.searchsorted) that matches a whole array of frequencies in one call.
+Tables can be built from a definition dictionary like a440_dict, or
+generated in equal temperament for any reference tuning of A4.
+"""
+
+import numpy as np
+
+
+# Note letters and accidentals in order from C, in the
+# '[note][N for natural and S for sharp]' form used by a440_dict.
+NOTE_NAMES = ['CN', 'CS', 'DN', 'DS', 'EN', 'FN', 'FS', 'GN', 'GS', 'AN',
+              'AS', 'BN']
+
+
+class PitchIndex:
+    """
+    Sorted note frequencies and names supporting nearest pitch lookup.
+    """
+    def __init__(self, frequencies, notes):
+        """
+        frequencies : Iterable of note frequencies in Hertz (Hz).
+        notes       : Iterable of note strings, at the same index as their
+                      frequency. Need not be sorted.
+        """
+        frequencies = np.asarray(frequencies, dtype=float)
+        order = np.argsort(frequencies, kind='stable')
+        # Sorted frequencies, so that they can be binary searched.
+        self.frequencies = frequencies[order]
+        # Note strings at the same index as their frequency.
+        self.notes = np.asarray(notes)[order]
+
+    def __len__(self):
+        return len(self.frequencies)
+
+    @classmethod
+    def from_mapping(cls, mapping):
+        """
+        Builds an index from a dictionary of float frequencies and string
+        notes, such as a440_dict.freq_mapping.
+        """
+        return cls(list(mapping.keys()), list(mapping.values()))
+
+    @classmethod
+    def for_tuning(cls, reference=440.0, octaves=range(0, 9), decimals=2):
+        """
+        Generates an equal tempered index for any tuning of A4.
+
+        reference : Frequency of A4 in Hertz (Hz), e.g. 432, 440 or 443.
+        octaves   : Octaves to include, by scientific pitch number.
+        decimals  : Number of decimals frequencies are rounded to. The
+                    default matches a440_dict.
+
+        Returns a PitchIndex.
+        """
+        octaves = np.asarray(list(octaves))
+        # Semitones away from A4 for every note of every octave.
+        semitones = (octaves[:, np.newaxis] - 4) * 12 + \
+                    np.arange(12)[np.newaxis, :] - 9
+        frequencies = np.round(reference * 2.0 ** (semitones / 12.0), decimals)
+        notes = ['%s%d' % (name, octave) for octave in octaves
+                 for name in NOTE_NAMES]
+        return cls(frequencies.ravel(), notes)
+
+    def nearest(self, frequency):
+        """
+        Finds the closest note to each frequency.
+
+        frequency : Frequency in Hertz (Hz), or an array of them.
+
+        Returns a tuple of (closest frequencies, notes), with the same
+        shape as the input. On a tie, the lower note is picked.
+        """
+        frequency = np.asarray(frequency, dtype=float)
+        right = np.searchsorted(self.frequencies, frequency)
+        right = np.clip(right, 1, len(self.frequencies) - 1)
+        left = right - 1
+        pick_left = np.abs(frequency - self.frequencies[left]) <= \
+                    np.abs(self.frequencies[right] - frequency)
+        index = np.where(pick_left, left, right)
+        return self.frequencies[index], self.notes[index]
+
+    def match(self, frequency):
+        """
+        Matches frequencies to notes along with a confidence for each.
+
+        frequency : Frequency in Hertz (Hz), or an array of them.
+
+        Returns a tuple of (notes, confidences), where the confidence is
+        the percentage of the frequency that the closest note is off by,
+        taken away from 100.
+        """
+        frequency = np.asarray(frequency, dtype=float)
+        closest, notes = self.nearest(frequency)
+        confidence = 100 * (1 - np.abs((frequency - closest) / frequency))
+        return notes, confidence
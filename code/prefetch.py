@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+"""
+Read ahead of analysis when scanning archives on slow storage.
+
+A background thread reads whole files into memory, in order, while the
+files before them are being analysed, so the disk (or network mount) and
+the CPU work at the same time rather than in turn. The queue of files read
+but not yet taken is bounded both in number and in bytes, and the time
+either side spends waiting on the other is recorded: a reader that keeps
+waiting for room means analysis is the bottleneck, and a consumer that
+keeps waiting for files means the storage is.
+"""
+
+from collections import deque
+import os
+import threading
+import time
+
+
+class Prefetcher:
+    """
+    Iterable of (filename, contents) read ahead on a background thread.
+
+    Files that cannot be read give the OSError in place of the contents,
+    so one missing file does not stop the scan. Use as a context manager,
+    or call close, to stop the reader early.
+    """
+    def __init__(self, files, depth=4, max_bytes=256 << 20):
+        """
+        files     : Iterable of file paths, read in order.
+        depth     : Most files read ahead of the consumer.
+        max_bytes : Most bytes read ahead of the consumer. A file larger
+                    than this is still read, but only once the queue is
+                    empty.
+        """
+        self.files = list(files)
+        self.depth = max(1, depth)
+        self.max_bytes = max_bytes
+        # Files read but not yet taken, with the bytes they hold.
+        self.queue = deque()
+        self.queued_bytes = 0
+        self.condition = threading.Condition()
+        self.done = False
+        self.closed = False
+        self.stats = {'files': 0, 'bytes': 0, 'read_seconds': 0.0,
+                      'reader_stalls': 0, 'reader_stall_seconds': 0.0,
+                      'consumer_stalls': 0, 'consumer_stall_seconds': 0.0,
+                      'peak_files': 0, 'peak_bytes': 0}
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def full(self, size):
+        """
+        Returns whether a file of the given size has to wait for room.
+        """
+        return self.queue and (len(self.queue) >= self.depth or
+                               self.queued_bytes + size > self.max_bytes)
+
+    def run(self):
+        """
+        Reads every file into the queue. Runs on the reader thread.
+        """
+        try:
+            for filename in self.files:
+                try:
+                    size = os.path.getsize(filename)
+                except OSError:
+                    size = 0
+                with self.condition:
+                    if self.full(size) and not self.closed:
+                        start = time.perf_counter()
+                        while self.full(size) and not self.closed:
+                            self.condition.wait()
+                        self.stats['reader_stalls'] += 1
+                        self.stats['reader_stall_seconds'] += \
+                            time.perf_counter() - start
+                    if self.closed:
+                        return
+
+                start = time.perf_counter()
+                try:
+                    with open(filename, 'rb') as f:
+                        data = f.read()
+                except OSError as e:
+                    data = e
+                seconds = time.perf_counter() - start
+
+                with self.condition:
+                    size = len(data) if isinstance(data, bytes) else 0
+                    self.queue.append((filename, data))
+                    self.queued_bytes += size
+                    self.stats['files'] += 1
+                    self.stats['bytes'] += size
+                    self.stats['read_seconds'] += seconds
+                    self.stats['peak_files'] = max(self.stats['peak_files'],
+                                                   len(self.queue))
+                    self.stats['peak_bytes'] = max(self.stats['peak_bytes'],
+                                                   self.queued_bytes)
+                    self.condition.notify_all()
+        finally:
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+
+    def __iter__(self):
+        """
+        Yields tuples of (filename, bytes or OSError) in the order given.
+        """
+        while True:
+            with self.condition:
+                if not self.queue and not self.done:
+                    start = time.perf_counter()
+                    while not self.queue and not self.done:
+                        self.condition.wait()
+                    self.stats['consumer_stalls'] += 1
+                    self.stats['consumer_stall_seconds'] += \
+                        time.perf_counter() - start
+                if not self.queue:
+                    return
+                filename, data = self.queue.popleft()
+                if isinstance(data, bytes):
+                    self.queued_bytes -= len(data)
+                self.condition.notify_all()
+            yield filename, data
+
+    def metrics(self):
+        """
+        Returns a copy of the counters: files and bytes read, seconds spent
+        reading, how often and how long the reader waited for room and the
+        consumer waited for files, and the most files and bytes queued.
+        """
+        with self.condition:
+            return dict(self.stats)
+
+    def close(self):
+        """
+        Stops the reader and drops anything queued.
+        """
+        with self.condition:
+            self.closed = True
+            self.queue.clear()
+            self.queued_bytes = 0
+            self.condition.notify_all()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
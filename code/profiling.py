@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+"""
+Timing and counter instrumentation for the recognition pipeline.
+
+The analysis code wraps each stage (decoding, the fft, peak picking,
+aggregation and classification) in stage(). When no hooks are registered
+this hands back a shared object that does nothing, so instrumentation costs
+one list check per stage. Once a hook is registered, it is called with the
+name, duration and counters (frames, bytes, ffts, ...) of every stage.
+"""
+
+import threading
+import time
+
+
+# Callables taking (stage name, seconds, counters dictionary).
+hooks = []
+
+
+def add_hook(hook):
+    """
+    Registers a callable to receive (stage name, seconds, counters) for
+    every stage run from now on.
+    """
+    hooks.append(hook)
+
+
+def remove_hook(hook):
+    """
+    Unregisters a hook added with add_hook.
+    """
+    hooks.remove(hook)
+
+
+class Stage:
+    """
+    Times a block of code and reports it to the registered hooks.
+    """
+    def __init__(self, name, counters):
+        self.name = name
+        self.counters = counters
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        seconds = time.perf_counter() - self.start
+        for hook in list(hooks):
+            hook(self.name, seconds, self.counters)
+
+    def count(self, **counters):
+        """
+        Adds to the counters reported for this stage.
+        """
+        for name, value in counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+
+class NullStage:
+    """
+    Stand in for Stage when nothing is listening.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def count(self, **counters):
+        pass
+
+
+NULL_STAGE = NullStage()
+
+
+def stage(name, **counters):
+    """
+    Returns a context manager timing a stage of the pipeline.
+
+    name     : Name of the stage, e.g. 'fft'.
+    counters : Initial counters for the stage. More can be added with the
+               count method of the returned object.
+    """
+    if not hooks:
+        return NULL_STAGE
+    return Stage(name, counters)
+
+
+class Profile:
+    """
+    Hook that totals the time, calls and counters of every stage while it
+    is active. Use as a context manager around the code to profile.
+    """
+    def __init__(self):
+        # Totals by stage name, in the order stages were first seen.
+        self.stages = {}
+        # Stages may finish on analysis worker threads.
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        add_hook(self)
+        return self
+
+    def __exit__(self, *args):
+        remove_hook(self)
+
+    def __call__(self, name, seconds, counters):
+        with self.lock:
+            totals = self.stages.setdefault(name, {'seconds': 0.0,
+                                                   'calls': 0})
+            totals['seconds'] += seconds
+            totals['calls'] += 1
+            for counter, value in counters.items():
+                totals[counter] = totals.get(counter, 0) + value
+
+    def __str__(self):
+        """
+        Returns one line per stage for easy printing.
+        """
+        lines = []
+        for name, totals in self.stages.items():
+            counters = ' '.join('%s=%s' % item for item in totals.items()
+                                if item[0] not in ('seconds', 'calls'))
+            lines.append("%-10s %9.4fs %5d calls %s" % (name, totals['seconds'],
+                                                        totals['calls'],
+                                                        counters))
+        return '\n'.join(lines)
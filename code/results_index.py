@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+
+"""
+Queryable index of recognition results across an archive.
+
+Stores the label, frequency, confidence or error and analysis settings of
+every file, and optionally of every segment of a chord transcription, in
+an SQLite database indexed by label, pitch and file. Questions about the
+archive ("all clips containing E Major with error below 5", "all notes in
+octave 2") then become indexed queries instead of a new analysis run.
+Updates are incremental: only files that are new, have changed on disk or
+were analysed with other settings are recognized again.
+
+    $ python3 results_index.py add archive.db chord /data/chords --segment 2
+    $ python3 results_index.py query archive.db --label "E Major" --max-error 5
+"""
+
+from batch import collect_files, failure, recognize
+from Chord import ANALYZER as CHORD_ANALYZER, CLASSIFIER, MODEL
+from Note import ANALYZER as NOTE_ANALYZER
+from pitch_index import NOTE_NAMES
+from transcribe import transcribe
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import hashlib
+import json
+import numpy as np
+import os
+import sqlite3
+import sys
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER,
+    kind TEXT,
+    params TEXT,
+    status TEXT,
+    message TEXT
+);
+CREATE TABLE IF NOT EXISTS results (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    start REAL,
+    end REAL,
+    label TEXT,
+    pitch INTEGER,
+    octave INTEGER,
+    frequency REAL,
+    confidence REAL,
+    error REAL,
+    frequencies TEXT
+);
+CREATE INDEX IF NOT EXISTS results_label ON results (label, error);
+CREATE INDEX IF NOT EXISTS results_pitch ON results (pitch);
+CREATE INDEX IF NOT EXISTS results_octave ON results (octave);
+CREATE INDEX IF NOT EXISTS results_frequency ON results (frequency);
+CREATE INDEX IF NOT EXISTS results_file ON results (file_id);
+'''
+
+
+def analysis_params(kind, segment=None):
+    """
+    Returns the settings results of a kind are computed with, so that
+    files are analysed again when they change. Chords, and their segments,
+    are extracted as the classifier was trained, as in Chord.
+    """
+    analyzer = NOTE_ANALYZER if kind == 'note' else CHORD_ANALYZER
+    params = {'chunk': analyzer.chunk, 'num_peaks': analyzer.num_peaks,
+              'dtype': np.dtype(analyzer.dtype).name}
+    if kind == 'chord':
+        params['model'] = MODEL
+        # Retraining a model in place keeps its path, so results depend on
+        # the contents too.
+        params['model_hash'] = model_hash(MODEL) if MODEL else None
+        params['features'] = CLASSIFIER.settings.get('features', 'peaks')
+        params['num_notes'] = CLASSIFIER.settings.get('num_notes', 3)
+        params['segment'] = segment
+    return params
+
+
+def model_hash(path):
+    """
+    Returns the SHA-256 hex digest of a model file's contents.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def note_pitch(label):
+    """
+    Returns a tuple of (MIDI note number, octave) of a note label such as
+    'CS4', or (None, None) if it is not one.
+    """
+    try:
+        octave = int(label[2:])
+        return NOTE_NAMES.index(label[:2]) + 12 * (octave + 1), octave
+    except (TypeError, ValueError):
+        return None, None
+
+
+def analyse(kind, filename, segment=None):
+    """
+    Recognizes one file, and for chords the segments of its transcription.
+    Used as the process pool task.
+
+    kind     : Either 'note' or 'chord'.
+    filename : Path to the .wav file.
+    segment  : Seconds per transcription segment. Defaults to none.
+
+    Returns a tuple of (result dictionary, as from batch.recognize, list of
+    (start, end, chord, error) segments).
+    """
+    result = recognize(kind, filename)
+    segments = []
+    if kind == 'chord' and segment and result['status'] == 'ok':
+        try:
+            segments = list(transcribe(filename, segment))
+        except Exception as e:
+            result['message'] = 'segments %s: %s' % (type(e).__name__, e)
+    return result, segments
+
+
+class ResultsIndex:
+    """
+    SQLite database of recognition results.
+    """
+    def __init__(self, path):
+        """
+        path : Database file, created if missing.
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        # Readers can query while an update is being written.
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.executescript(SCHEMA)
+
+    def stale(self, files, kind, params):
+        """
+        Returns the files that are not indexed with the given settings, or
+        have changed on disk since they were.
+        """
+        known = {row['path']: row for row in self.connection.execute(
+            'SELECT path, size, mtime_ns, kind, params FROM files')}
+        description = json.dumps(params, sort_keys=True)
+        stale = []
+        for filename in files:
+            path = os.path.abspath(filename)
+            row = known.get(path)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stale.append(path)
+                continue
+            if row is None or row['size'] != stat.st_size or \
+               row['mtime_ns'] != stat.st_mtime_ns or row['kind'] != kind or \
+               row['params'] != description:
+                stale.append(path)
+        return stale
+
+    def store(self, kind, params, result, segments=()):
+        """
+        Replaces the results of one file.
+
+        kind     : Either 'note' or 'chord'.
+        params   : Settings the results were computed with.
+        result   : Result dictionary, as from batch.recognize.
+        segments : Iterable of (start, end, chord, error) segments.
+        """
+        path = result['file']
+        try:
+            stat = os.stat(path)
+            size, mtime_ns = stat.st_size, stat.st_mtime_ns
+        except OSError:
+            size = mtime_ns = None
+        with self.connection:
+            self.connection.execute('DELETE FROM files WHERE path = ?',
+                                    (path,))
+            file_id = self.connection.execute(
+                'INSERT INTO files (path, size, mtime_ns, kind, params, '
+                'status, message) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (path, size, mtime_ns, kind, json.dumps(params, sort_keys=True),
+                 result['status'], result.get('message'))).lastrowid
+            if result['status'] != 'ok':
+                return
+            rows = []
+            if kind == 'note':
+                pitch, octave = note_pitch(result['note'])
+                rows.append((file_id, None, None, result['note'], pitch,
+                             octave, result['frequency'], result['confidence'],
+                             None, None))
+            else:
+                # Chords classified by chroma have no frequencies.
+                frequencies = result.get('frequencies')
+                if frequencies is not None:
+                    frequencies = json.dumps(frequencies)
+                rows.append((file_id, None, None, result['chord'], None, None,
+                             None, None, result['error'], frequencies))
+                rows.extend((file_id, start, end, chord, None, None, None,
+                             None, error, None)
+                            for start, end, chord, error in segments)
+            self.connection.executemany(
+                'INSERT INTO results (file_id, start, end, label, pitch, '
+                'octave, frequency, confidence, error, frequencies) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def update(self, kind, files, workers=None, segment=None):
+        """
+        Recognizes the files that are new or stale on a process pool and
+        stores their results as they complete.
+
+        kind    : Either 'note' or 'chord'.
+        files   : List of .wav file paths.
+        workers : Number of worker processes. Defaults to the number of
+                  CPUs.
+        segment : Seconds per transcription segment for chords. Defaults
+                  to whole files only.
+
+        Returns a tuple of (files analysed, files already up to date).
+        """
+        params = analysis_params(kind, segment)
+        stale = self.stale(files, kind, params)
+        if stale:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(analyse, kind, path, segment): path
+                           for path in stale}
+                for future in as_completed(futures):
+                    try:
+                        result, segments = future.result()
+                    except Exception as e:
+                        # The worker itself died, e.g. the pool broke.
+                        result, segments = failure(futures[future], e), []
+                    self.store(kind, params, result, segments)
+        return len(stale), len(files) - len(stale)
+
+    def prune(self):
+        """
+        Removes the results of files no longer on disk.
+
+        Returns the number of files removed.
+        """
+        missing = [(row['path'],) for row in
+                   self.connection.execute('SELECT path FROM files')
+                   if not os.path.exists(row['path'])]
+        with self.connection:
+            self.connection.executemany('DELETE FROM files WHERE path = ?',
+                                        missing)
+        return len(missing)
+
+    def query(self, kind=None, label=None, octave=None, low=None, high=None,
+              max_error=None, min_confidence=None, path=None, scope='all',
+              limit=None):
+        """
+        Finds stored results. Every criterion given must hold.
+
+        kind           : Either 'note' or 'chord'.
+        label          : Note or chord label, e.g. 'EN2' or 'E Major'.
+        octave         : Octave of notes.
+        low            : Lowest note frequency in Hertz (Hz).
+        high           : Highest note frequency in Hertz (Hz).
+        max_error      : Largest chord error.
+        min_confidence : Smallest note confidence.
+        path           : Glob pattern the absolute file path must match.
+        scope          : 'file' for whole file results, 'segment' for
+                         transcription segments or 'all' for both.
+        limit          : Most rows to return.
+
+        Returns a list of dictionaries, one per matching result, ordered by
+        file and start time.
+        """
+        conditions, values = [], []
+        for column, operator, value in (('files.kind', '=', kind),
+                                        ('label', '=', label),
+                                        ('octave', '=', octave),
+                                        ('frequency', '>=', low),
+                                        ('frequency', '<=', high),
+                                        ('error', '<=', max_error),
+                                        ('confidence', '>=', min_confidence),
+                                        ('path', 'GLOB', path)):
+            if value is not None:
+                conditions.append('%s %s ?' % (column, operator))
+                values.append(value)
+        if scope == 'file':
+            conditions.append('start IS NULL')
+        elif scope == 'segment':
+            conditions.append('start IS NOT NULL')
+        sql = 'SELECT path, files.kind AS kind, start, end, label, pitch, ' \
+              'octave, frequency, confidence, error, frequencies, params ' \
+              'FROM results JOIN files ON files.id = results.file_id'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY path, start'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            values.append(limit)
+        rows = []
+        for row in self.connection.execute(sql, values):
+            row = dict(row)
+            for name in ('frequencies', 'params'):
+                if row[name] is not None:
+                    row[name] = json.loads(row[name])
+            rows.append(row)
+        return rows
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def main():
+    """
+    Add files to an index or query it from the command line. Queries print
+    one line of JSON per matching result.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    add = commands.add_parser('add', help='recognize new or changed files')
+    add.add_argument('database')
+    add.add_argument('kind', choices=['note', 'chord'])
+    add.add_argument('sources', nargs='+',
+                     help='directories, glob patterns or manifest files')
+    add.add_argument('-j', '--workers', type=int, default=None)
+    add.add_argument('--segment', type=float, default=None,
+                     help='also index chord transcription segments of this '
+                          'many seconds')
+    add.add_argument('--prune', action='store_true',
+                     help='remove files no longer on disk')
+
+    query = commands.add_parser('query', help='print matching results')
+    query.add_argument('database')
+    query.add_argument('--kind', choices=['note', 'chord'])
+    query.add_argument('--label')
+    query.add_argument('--octave', type=int)
+    query.add_argument('--low', type=float, help='lowest frequency in Hz')
+    query.add_argument('--high', type=float, help='highest frequency in Hz')
+    query.add_argument('--max-error', type=float)
+    query.add_argument('--min-confidence', type=float)
+    query.add_argument('--path', help='glob pattern of file paths')
+    query.add_argument('--scope', choices=['all', 'file', 'segment'],
+                       default='all')
+    query.add_argument('--limit', type=int)
+    args = parser.parse_args()
+
+    with ResultsIndex(args.database) as index:
+        if args.command == 'add':
+            if args.prune:
+                print("Removed %d missing files." % index.prune(),
+                      file=sys.stderr)
+            analysed, current = index.update(args.kind,
+                                             collect_files(args.sources),
+                                             args.workers, args.segment)
+            print("Analysed %d files, %d already up to date." %
+                  (analysed, current), file=sys.stderr)
+            return
+        for row in index.query(args.kind, args.label, args.octave, args.low,
+                               args.high, args.max_error, args.min_confidence,
+                               args.path, args.scope, args.limit):
+            print(json.dumps(row))
+
+
+if  __name__ =='__main__':
+    main()
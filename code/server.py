@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+
+"""
+Resident note and chord recognition server.
+
+Keeps the classifier, window tables and pitch index loaded in a pool of
+worker processes and answers recognition requests over HTTP, on a TCP port
+or a Unix socket, so a request costs the analysis alone rather than a new
+interpreter and its imports. At most a fixed number of requests are queued
+or running at once; beyond that the server answers 503 straight away, so
+clients back off instead of piling up behind a growing queue.
+
+    POST /note or /chord   Body is a .wav file, or raw little endian
+                           16-bit PCM with ?rate=44100&channels=2.
+    GET /health            Worker and queue status.
+"""
+
+from analysis import Analyzer
+from batch import summarize
+from Chord import ANALYZER as CHORD_ANALYZER, Chord
+from Note import ANALYZER as NOTE_ANALYZER, Note
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import argparse
+import functools
+import json
+import multiprocessing
+import numpy as np
+import os
+import socket
+import socketserver
+import threading
+
+
+class Busy(Exception):
+    """
+    Raised when a request arrives while the queue is full.
+    """
+
+
+@functools.lru_cache(maxsize=None)
+def pcm_analyzer(kind, frame_rate, channels):
+    """
+    Returns an Analyzer for raw PCM at the given rate and channel count,
+    with the chunk size and number of peaks of the shared analyzer of the
+    kind. Built once per worker and format.
+    """
+    shared = NOTE_ANALYZER if kind == 'note' else CHORD_ANALYZER
+    return Analyzer(chunk=shared.chunk, num_peaks=shared.num_peaks,
+                    frame_rate=frame_rate, channels=channels)
+
+
+def load_worker():
+    """
+    Builds the default analyzers in a new worker process, so the first
+    request it takes costs the analysis alone. Used as the process pool
+    initializer.
+    """
+    for kind in ('note', 'chord'):
+        pcm_analyzer(kind, 44100, 2)
+
+
+def recognize_upload(kind, data, frame_rate=44100, channels=2):
+    """
+    Runs recognition on an uploaded recording. Used as the process pool
+    task.
+
+    kind       : Either 'note' or 'chord'.
+    data       : bytes of a .wav file, or of raw little endian 16-bit PCM.
+    frame_rate : Frame rate of raw PCM - frames / second.
+    channels   : Number of interleaved channels of raw PCM.
+
+    Returns a dictionary of results, as from batch.summarize.
+    """
+    recognizer = Note if kind == 'note' else Chord
+    if data[:4] == b'RIFF':
+        return summarize(recognizer(data))
+    samples = np.frombuffer(data, dtype='<i2', count=len(data) // 2)
+    return summarize(recognizer(samples, analyzer=pcm_analyzer(kind, frame_rate,
+                                                               channels)))
+
+
+class RecognitionService:
+    """
+    Bounded pool of warm recognition workers shared by the request
+    handlers.
+    """
+    def __init__(self, workers=None, queue_size=None, max_bytes=64 << 20,
+                 timeout=60.0, read_timeout=30.0):
+        """
+        workers      : Number of worker processes. Defaults to the number
+                       of CPUs.
+        queue_size   : Number of requests that may wait for a worker, on
+                       top of the ones running. Defaults to twice the
+                       workers.
+        max_bytes    : Largest upload accepted.
+        timeout      : Seconds to wait for a result before giving up.
+        read_timeout : Seconds a client may go silent while sending a
+                       request before its connection, and its slot, are
+                       dropped.
+        """
+        self.workers = workers or os.cpu_count() or 1
+        if queue_size is None:
+            queue_size = 2 * self.workers
+        self.capacity = self.workers + queue_size
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.read_timeout = read_timeout
+        # Workers would otherwise be forked from a handler thread on the
+        # first submit, which is unsafe with other threads running.
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in
+                                              methods else 'spawn')
+        self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                        mp_context=context,
+                                        initializer=load_worker)
+        # One slot per request queued or running.
+        self.slots = threading.BoundedSemaphore(self.capacity)
+        self.lock = threading.Lock()
+        self.pending = 0
+
+    def start(self):
+        """
+        Starts every worker and waits until they are running, so that no
+        request pays for starting one.
+        """
+        futures = [self.pool.submit(os.getpid) for _ in range(self.workers)]
+        for future in futures:
+            future.result()
+
+    def reserve(self):
+        """
+        Takes a slot for a request, without waiting.
+
+        Raises Busy if every slot is taken.
+        """
+        if not self.slots.acquire(blocking=False):
+            raise Busy()
+        with self.lock:
+            self.pending += 1
+
+    def release(self, *args):
+        """
+        Gives back a slot taken with reserve.
+        """
+        with self.lock:
+            self.pending -= 1
+        self.slots.release()
+
+    def recognize(self, kind, data, frame_rate=44100, channels=2):
+        """
+        Runs recognize_upload on the pool, in a slot taken with reserve.
+        The slot is given back once the worker finishes, even if the caller
+        has stopped waiting.
+
+        Raises concurrent.futures.TimeoutError if the result takes longer
+        than the timeout.
+        """
+        try:
+            future = self.pool.submit(recognize_upload, kind, data,
+                                      frame_rate, channels)
+        except Exception:
+            self.release()
+            raise
+        future.add_done_callback(self.release)
+        return future.result(timeout=self.timeout)
+
+    def status(self):
+        """
+        Returns a dictionary describing the load on the service.
+        """
+        return {'status': 'ok', 'workers': self.workers,
+                'capacity': self.capacity, 'pending': self.pending}
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+
+class RecognitionHandler(BaseHTTPRequestHandler):
+    """
+    HTTP front end of a RecognitionService, found at self.server.service.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, code, body, headers=()):
+        """
+        Sends a JSON response.
+        """
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, code, message, headers=()):
+        """
+        Sends an error as JSON and closes the connection, since the body of
+        the request may not have been read.
+        """
+        self.close_connection = True
+        self.send_json(code, {'status': 'failed', 'message': message},
+                       tuple(headers) + (('Connection', 'close'),))
+
+    def setup(self):
+        # A client that stalls mid-request times out instead of holding its
+        # thread, and slot, forever.
+        self.timeout = self.server.service.read_timeout
+        super().setup()
+
+    def address_string(self):
+        # Unix socket peers have no (host, port) address.
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/health':
+            self.send_json(200, self.server.service.status())
+        else:
+            self.send_error_json(404, 'not found')
+
+    def do_POST(self):
+        service = self.server.service
+        url = urlparse(self.path)
+        kind = url.path.strip('/')
+        if kind not in ('note', 'chord'):
+            self.send_error_json(404, 'not found')
+            return
+        try:
+            query = {name: int(values[-1])
+                     for name, values in parse_qs(url.query).items()
+                     if name in ('rate', 'channels')}
+        except ValueError:
+            self.send_error_json(400, 'rate and channels must be integers')
+            return
+        length = self.headers.get('Content-Length')
+        if length is None or not length.isdigit():
+            self.send_error_json(411, 'Content-Length required')
+            return
+        if int(length) > service.max_bytes:
+            self.send_error_json(413, 'upload larger than %d bytes' %
+                                 service.max_bytes)
+            return
+        # Turn requests away before reading their upload when full.
+        try:
+            service.reserve()
+        except Busy:
+            self.send_error_json(503, 'server busy', [('Retry-After', '1')])
+            return
+
+        length = int(length)
+        try:
+            data = self.rfile.read(length)
+        except socket.timeout:
+            service.release()
+            self.send_error_json(408, 'upload timed out')
+            return
+        except Exception:
+            service.release()
+            raise
+        if len(data) < length:
+            service.release()
+            self.send_error_json(400, 'upload shorter than Content-Length')
+            return
+        try:
+            result = service.recognize(kind, data, query.get('rate', 44100),
+                                       query.get('channels', 2))
+        except TimeoutError:
+            self.send_error_json(504, 'recognition timed out')
+            return
+        except Exception as e:
+            self.send_error_json(422, '%s: %s' % (type(e).__name__, e))
+            return
+        result['status'] = 'ok'
+        self.send_json(200, result)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Threaded HTTP server listening on a Unix socket.
+    """
+    daemon_threads = True
+
+    def server_bind(self):
+        # Replace a socket left behind by an earlier run.
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        super().server_bind()
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def make_server(service, host='127.0.0.1', port=8000, unix_socket=None):
+    """
+    Builds an HTTP server for a RecognitionService.
+
+    service     : RecognitionService to answer requests with.
+    host        : Address to listen on.
+    port        : TCP port to listen on.
+    unix_socket : Path of a Unix socket to listen on instead of TCP.
+
+    Returns the server; call serve_forever to run it.
+    """
+    if unix_socket:
+        server = UnixHTTPServer(unix_socket, RecognitionHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), RecognitionHandler)
+    server.service = service
+    return server
+
+
+def main():
+    """
+    Run the recognition server from the command line until interrupted.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=8000)
+    parser.add_argument('--unix', default=None, metavar='PATH',
+                        help='listen on a Unix socket instead of TCP')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of worker processes')
+    parser.add_argument('-q', '--queue', type=int, default=None,
+                        help='requests that may wait for a worker')
+    parser.add_argument('--max-size', type=int, default=64,
+                        help='largest upload in megabytes')
+    parser.add_argument('--timeout', type=float, default=60.0,
+                        help='seconds to wait for a result')
+    parser.add_argument('--read-timeout', type=float, default=30.0,
+                        help='seconds a client may stall while uploading')
+    args = parser.parse_args()
+
+    service = RecognitionService(args.workers, args.queue, args.max_size << 20,
+                                 args.timeout, args.read_timeout)
+    service.start()
+    server = make_server(service, args.host, args.port, args.unix)
+    print("Listening on %s" % (args.unix or '%s:%d' % (args.host, args.port)),
+          flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if  __name__ =='__main__':
+    main()
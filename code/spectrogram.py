@@ -6,81 +6,188 @@
 # Some modifications have been made, but most is consistent with answer.
 
 
+import argparse
+import functools
 import numpy as np
-from matplotlib import pyplot as plt
-import scipy.io.wavfile as wav
-from numpy.lib import stride_tricks
+from analysis import frame_signal
+from wav_reader import WavFile
+
+""" number of frames stft gives a signal of the given length """
+def num_frames(length, frameSize, hopSize):
+    # The signal is centered by half a frame of zeros at the start.
+    return int(np.ceil((length + frameSize//2 - frameSize) / float(hopSize))) + 1
+
+""" frames start to stop of the zero padded signal, without padding it all """
+def frame_block(sig, frameSize, hopSize, start, stop):
+    """
+    Builds a range of the frames stft takes of a signal.
+
+    sig       : One dimensional np.ndarray of samples, or a WavFile, which
+                is mixed down to mono a range at a time.
+    frameSize : Number of samples per frame.
+    hopSize   : Number of samples between frames.
+    start     : Index of the first frame.
+    stop      : Index one past the last frame.
+
+    Returns a (stop - start, frameSize) array of frames.
+    """
+    length = sig.nframes if isinstance(sig, WavFile) else len(sig)
+    # Range of the signal covered, relative to the start of the signal.
+    first = start * hopSize - frameSize//2
+    last = (stop - 1) * hopSize - frameSize//2 + frameSize
+    segment = np.zeros(last - first)
+    lo, hi = max(first, 0), min(last, length)
+    if hi > lo:
+        segment[lo - first:hi - first] = sig.mono(lo, hi) \
+            if isinstance(sig, WavFile) else sig[lo:hi]
+    return frame_signal(segment, frameSize, hopSize)
 
 """ short time fourier transform of audio signal """
 def stft(sig, frameSize, overlapFac=0.5, window=np.hanning):
     win = window(frameSize)
     hopSize = int(frameSize - np.floor(overlapFac * frameSize))
-
-    # zeros at beginning (thus center of 1st window should be for sample nr. 0)   
-    samples = np.append(np.zeros(int(np.floor(frameSize/2.0))), sig)    
-    # cols for windowing
-    cols = np.ceil( (len(samples) - frameSize) / float(hopSize)) + 1
-    # zeros at end (thus samples can be fully covered by frames)
-    samples = np.append(samples, np.zeros(frameSize))
-
-    frames = stride_tricks.as_strided(samples, shape=(int(cols), frameSize), strides=(samples.strides[0]*hopSize, samples.strides[0])).copy()
-    frames *= win
-
-    return np.fft.rfft(frames)    
-
-""" scale frequency axis logarithmically """    
-def logscale_spec(spec, sr=44100, factor=20.):
-    timebins, freqbins = np.shape(spec)
+    length = sig.nframes if isinstance(sig, WavFile) else len(sig)
+    cols = num_frames(length, frameSize, hopSize)
+
+    # zeros at beginning (thus center of 1st window should be for sample nr. 0)
+    # and at end (thus samples can be fully covered by frames)
+    return np.fft.rfft(frame_block(sig, frameSize, hopSize, 0, cols) * win)
+
+""" short time fourier transform magnitudes, a block of frames at a time """
+def iter_stft(sig, frameSize, overlapFac=0.5, window=np.hanning,
+              block_frames=1024):
+    """
+    Yields the magnitudes of stft, one block of frames at a time, so that
+    memory use does not grow with the length of the signal.
+
+    sig          : One dimensional np.ndarray of samples, or a WavFile.
+    frameSize    : Number of samples per frame.
+    overlapFac   : Fraction of each frame overlapping the next.
+    window       : Window function, as in stft.
+    block_frames : Number of frames transformed at once.
+
+    Yields tuples of (index of the first frame in the block, (frames,
+    frameSize//2 + 1) float32 magnitudes).
+    """
+    win = window(frameSize)
+    hopSize = int(frameSize - np.floor(overlapFac * frameSize))
+    length = sig.nframes if isinstance(sig, WavFile) else len(sig)
+    cols = num_frames(length, frameSize, hopSize)
+    for start in range(0, cols, block_frames):
+        stop = min(start + block_frames, cols)
+        frames = frame_block(sig, frameSize, hopSize, start, stop)
+        yield start, np.abs(np.fft.rfft(frames * win)).astype(np.float32)
+
+""" sparse matrix summing frequency bins into logarithmic bins """
+@functools.lru_cache(maxsize=None)
+def logscale_matrix(freqbins, sr=44100, factor=20.):
+    """
+    Builds the log frequency binning of logscale_spec as a sparse matrix.
+
+    freqbins : Number of frequency bins of the spectrum.
+    sr       : Sample rate of the signal.
+    factor   : Larger factors give more low frequency resolution.
+
+    Returns a tuple of (freqbins, log bins) scipy.sparse.csr_matrix and the
+    list of the center frequency of each log bin.
+    """
+    # Only needed for spectrograms, so not imported with the module.
+    import scipy.sparse
 
     scale = np.linspace(0, 1, freqbins) ** factor
     scale *= (freqbins-1)/max(scale)
-    scale = np.unique(np.round(scale))
+    scale = np.unique(np.round(scale)).astype(int)
 
-    # create spectrogram with new freq bins
-    newspec = np.complex128(np.zeros([timebins, len(scale)]))
-    for i in range(0, len(scale)):        
-        if i == len(scale)-1:
-            newspec[:,i] = np.sum(spec[:,int(scale[i]):], axis=1)
-        else:        
-            newspec[:,i] = np.sum(spec[:,int(scale[i]):int(scale[i+1])], axis=1)
+    # Every frequency bin belongs to the log bin starting at or below it.
+    column = np.searchsorted(scale, np.arange(freqbins), side='right') - 1
+    matrix = scipy.sparse.csr_matrix((np.ones(freqbins, dtype=np.float32),
+                                      (np.arange(freqbins), column)),
+                                     shape=(freqbins, len(scale)))
 
     # list center freq of bins
     allfreqs = np.abs(np.fft.fftfreq(freqbins*2, 1./sr)[:freqbins+1])
-    freqs = []
-    for i in range(0, len(scale)):
-        if i == len(scale)-1:
-            freqs += [np.mean(allfreqs[int(scale[i]):])]
-        else:
-            freqs += [np.mean(allfreqs[int(scale[i]):int(scale[i+1])])]
+    counts = np.diff(np.append(scale, len(allfreqs)))
+    freqs = list(np.add.reduceat(allfreqs, scale) / counts)
+    return matrix, freqs
 
-    return newspec, freqs
+""" scale frequency axis logarithmically """    
+def logscale_spec(spec, sr=44100, factor=20.):
+    # Magnitudes of the bins falling in each log bin are summed.
+    matrix, freqs = logscale_matrix(np.shape(spec)[1], sr, factor)
+    return np.asarray(np.abs(spec) @ matrix), freqs
+
+""" write spectrogram in decibels, a block of frames at a time """
+def write_spectrogram(audiopath, store=None, binsize=2**10, factor=1.0,
+                      block_frames=1024):
+    """
+    Computes the log frequency spectrogram of a .wav file in decibels.
+
+    The file is memory mapped and transformed a block of frames at a time,
+    and each block is written out before the next is read, so with a store
+    the memory used does not depend on the length of the file.
+
+    audiopath    : Path to the .wav file. Channels are mixed down to mono.
+    store        : Path of a .npy file to write the spectrogram to, as a
+                   memory map. Defaults to an array in memory.
+    binsize      : Number of samples per frame.
+    factor       : Log scaling factor, as in logscale_spec.
+    block_frames : Number of frames transformed at once.
+
+    Returns a tuple of the (timebins, freqbins) float32 spectrogram, the
+    center frequency of each bin, the sample rate and number of samples.
+    """
+    with WavFile(audiopath) as waveform:
+        hopSize = binsize - binsize//2
+        timebins = num_frames(waveform.nframes, binsize, hopSize)
+        matrix, freqs = logscale_matrix(binsize//2 + 1, waveform.frame_rate,
+                                        factor)
+        shape = (timebins, len(freqs))
+        if store:
+            ims = np.lib.format.open_memmap(store, mode='w+',
+                                            dtype=np.float32, shape=shape)
+        else:
+            ims = np.empty(shape, dtype=np.float32)
+        for start, magnitude in iter_stft(waveform, binsize,
+                                          block_frames=block_frames):
+            with np.errstate(divide='ignore'):
+                # amplitude to decibel
+                ims[start:start + len(magnitude)] = \
+                    20.*np.log10(np.asarray(magnitude @ matrix)/10e-6)
+        if store:
+            ims.flush()
+        return ims, freqs, waveform.frame_rate, waveform.nframes
 
 """ plot spectrogram"""
-def plotstft(audiopath, binsize=2**10, plotpath=None, colormap="jet"):
-    samplerate, samples = wav.read(audiopath)
+def plotstft(audiopath, binsize=2**10, plotpath=None, colormap="jet",
+             store=None, max_columns=4096):
+    # matplotlib is slow to import, so only load it once there is a plot.
+    from matplotlib import pyplot as plt
 
-    s = stft(samples, binsize)
-
-    sshow, freq = logscale_spec(s, factor=1.0, sr=samplerate)
-
-    ims = 20.*np.log10(np.abs(sshow)/10e-6) # amplitude to decibel
+    ims, freq, samplerate, length = write_spectrogram(audiopath, store, binsize)
 
     timebins, freqbins = np.shape(ims)
 
     print("timebins: ", timebins)
     print("freqbins: ", freqbins)
 
+    # Long files have more frames than pixels, so show the loudest of each
+    # run of frames, reading the spectrogram a run at a time.
+    step = int(np.ceil(timebins / float(max_columns)))
+    shown = np.array([ims[i:i + step].max(axis=0)
+                      for i in range(0, timebins, step)])
+    columns = len(shown)
+
     plt.figure(figsize=(15, 7.5))
-    plt.imshow(np.transpose(ims), origin="lower", aspect="auto", cmap=colormap, interpolation="none")
+    plt.imshow(np.transpose(shown), origin="lower", aspect="auto", cmap=colormap, interpolation="none")
     plt.colorbar()
 
     plt.xlabel("time (s)")
     plt.ylabel("frequency (hz)")
-    plt.xlim([0, timebins-1])
+    plt.xlim([0, columns-1])
     plt.ylim([0, freqbins])
 
-    xlocs = np.float32(np.linspace(0, timebins-1, 5))
-    plt.xticks(xlocs, ["%.02f" % l for l in ((xlocs*len(samples)/timebins)+(0.5*binsize))/samplerate])
+    xlocs = np.float32(np.linspace(0, columns-1, 5))
+    plt.xticks(xlocs, ["%.02f" % l for l in ((xlocs*length/columns)+(0.5*binsize))/samplerate])
     ylocs = np.int16(np.round(np.linspace(0, freqbins-1, 10)))
     plt.yticks(ylocs, ["%.02f" % freq[i] for i in ylocs])
 
@@ -93,4 +200,24 @@ def plotstft(audiopath, binsize=2**10, plotpath=None, colormap="jet"):
 
     return ims
 
-ims = plotstft('../data/chords/train/major.wav')
+def main():
+    """
+    Plot the spectrogram of a .wav file from the command line, optionally
+    keeping the spectrogram itself in a .npy file.
+    """
+    parser = argparse.ArgumentParser(description='Plot the spectrogram of a '
+                                                 '.wav file.')
+    parser.add_argument('audiopath')
+    parser.add_argument('plotpath', nargs='?', default=None,
+                        help='image to save the plot to, instead of showing it')
+    parser.add_argument('--store', default=None, metavar='NPY',
+                        help='write the spectrogram in decibels to this .npy '
+                             'file, a block at a time')
+    parser.add_argument('--binsize', type=int, default=2**10)
+    args = parser.parse_args()
+
+    plotstft(args.audiopath, args.binsize, args.plotpath, store=args.store)
+
+
+if  __name__ =='__main__':
+    main()
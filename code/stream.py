@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+"""
+Streaming note and chord recognition from live or piped audio.
+
+Rather than opening a finished .wav file, the StreamRecognizer is fed raw
+16-bit PCM as it arrives (from standard input, a socket or any generator of
+bytes). It keeps a ring buffer of the most recent window of samples and
+emits an estimate every hop, so the latency is bounded by the hop size
+instead of the length of the recording.
+"""
+
+from analysis import blackman, peak_frequencies, power_spectrum
+from Chord import CLASSIFIER, Chord
+from Note import Note
+
+from collections import deque
+import argparse
+import numpy as np
+import socket
+import sys
+
+
+class RingBuffer:
+    """
+    Fixed size buffer holding the most recent samples of a stream.
+    """
+    def __init__(self, size):
+        """
+        size : Number of samples held by the buffer.
+        """
+        self.data = np.zeros(size)
+        # Position the next sample is written to.
+        self.position = 0
+        # Number of samples written so far, capped at the size.
+        self.filled = 0
+
+    def extend(self, samples):
+        """
+        Writes samples into the buffer, overwriting the oldest ones.
+
+        samples : One dimensional np.ndarray. Only the last buffer's worth
+                  is kept if it is longer than the buffer.
+        """
+        size = len(self.data)
+        if len(samples) > size:
+            # Everything before the last size samples would be overwritten.
+            self.position = (self.position + len(samples) - size) % size
+            self.filled = size
+            samples = samples[-size:]
+        end = self.position + len(samples)
+        if end <= size:
+            self.data[self.position:end] = samples
+        else:
+            split = size - self.position
+            self.data[self.position:] = samples[:split]
+            self.data[:end - size] = samples[split:]
+        self.position = end % size
+        self.filled = min(size, self.filled + len(samples))
+
+    def is_full(self):
+        """
+        Returns whether a whole window of samples has been written.
+        """
+        return self.filled == len(self.data)
+
+    def window(self):
+        """
+        Returns the buffered samples, oldest first.
+        """
+        return np.concatenate((self.data[self.position:],
+                               self.data[:self.position]))
+
+
+class StreamRecognizer:
+    """
+    Incremental note or chord recognizer for streams of 16-bit PCM.
+
+    Uses the same window and peak interpolation as the file based Note and
+    Chord classes. Each hop, the newest window is transformed and its peak
+    frequency added to a short history of peaks, which is aggregated into
+    an estimate in the same way as a whole file would be. Chords follow
+    the settings of their classifier: its chunk size, peaks per chunk and
+    number of notes, or the chroma of the recent windows.
+    """
+    def __init__(self, kind='note', frame_rate=44100, channels=2,
+                 chunk=None, hop_size=None, history=8, classifier=None):
+        """
+        kind       : Either 'note' or 'chord'.
+        frame_rate : Frame rate of the stream - frames / second.
+        channels   : Number of interleaved channels in the stream.
+        chunk      : Size of the sampling chunk. As in detect_frequency, the
+                     window is double the chunk size. Defaults to the chunk
+                     size the classifier was trained with, or 2048.
+        hop_size   : Number of samples between estimates. Defaults to the
+                     window size, so windows do not overlap.
+        history    : Number of recent window peaks used per estimate.
+        classifier : KNearestNeighbors chords are classified with. Defaults
+                     to the one Chord uses.
+        """
+        self.kind = kind
+        self.frame_rate = frame_rate
+        self.channels = channels
+        self.classifier = classifier or CLASSIFIER
+        settings = self.classifier.settings if kind == 'chord' else {}
+        # Feature vector, peaks per window and notes classified for chords.
+        self.features = settings.get('features', 'peaks')
+        self.num_peaks = settings.get('num_peaks', 1)
+        self.num_notes = settings.get('num_notes', 3)
+        self.chunk = chunk or settings.get('chunk', 2048)
+        # Same window as Note and Chord detect_frequency.
+        self.window = blackman(self.chunk*2)
+        self.hop_size = hop_size or len(self.window)
+        self.buffer = RingBuffer(len(self.window))
+        self.peaks = deque(maxlen=history)
+        # Samples received since the last estimate.
+        self.pending = 0
+        # Samples received in total, used to timestamp estimates.
+        self.samples_seen = 0
+        # Odd trailing byte left over from the last block of PCM.
+        self.remainder = b''
+
+    def feed(self, data):
+        """
+        Adds a block of PCM to the stream.
+
+        data : bytes of little endian 16-bit PCM (channels interleaved, as
+               in a .wav file) or an np.ndarray of samples.
+
+        Returns a list of the estimates completed by this block, as from
+        estimate, each with a 'time' in seconds added.
+        """
+        if isinstance(data, (bytes, bytearray)):
+            data = self.remainder + bytes(data)
+            usable = len(data) - len(data) % 2
+            self.remainder = data[usable:]
+            data = np.frombuffer(data[:usable], dtype='<i2')
+
+        estimates = []
+        start = 0
+        while start < len(data):
+            # Never write more than one hop before taking an estimate.
+            step = min(len(data) - start, self.hop_size - self.pending)
+            self.buffer.extend(data[start:start + step])
+            start += step
+            self.pending += step
+            self.samples_seen += step
+            if self.pending == self.hop_size:
+                self.pending = 0
+                if self.buffer.is_full():
+                    estimate = self.estimate()
+                    if estimate is not None:
+                        estimate['time'] = self.samples_seen / \
+                                float(self.frame_rate * self.channels)
+                        estimates.append(estimate)
+        return estimates
+
+    def estimate(self):
+        """
+        Transforms the newest window and updates the running estimate.
+
+        Returns a dictionary with the current label and its score, or None
+        when there are not yet enough usable peaks.
+        """
+        spectrum = power_spectrum(self.buffer.window()[np.newaxis], self.window)
+        if self.kind == 'note':
+            self.peaks.extend(peak_frequencies(spectrum, self.frame_rate,
+                                               self.chunk))
+        else:
+            self.peaks.extend(Chord.chunk_features(spectrum, self.frame_rate,
+                                                   self.chunk, self.features,
+                                                   self.num_peaks))
+        peaks = np.array(self.peaks)
+
+        if self.kind == 'note':
+            if not np.any(peaks > 0):
+                return None
+            frequency = Note.dominant_frequency(peaks)
+            note, confidence = Note.closest_note(frequency)
+            return {'label': note, 'frequency': float(frequency),
+                    'score': float(confidence)}
+
+        vector = Chord.combine_features(peaks, self.features, self.num_notes)
+        if vector is None:
+            return None
+        chord, error = Chord.classify(vector, self.classifier)
+        if self.features == 'chroma':
+            return {'label': chord, 'chroma': [float(c) for c in vector],
+                    'score': float(error)}
+        return {'label': chord, 'frequencies': [int(f) for f in vector],
+                'score': float(error)}
+
+    def run(self, blocks):
+        """
+        Feeds every block from an iterable and yields estimates as they
+        are completed.
+
+        blocks : Iterable of PCM blocks, as accepted by feed.
+        """
+        for block in blocks:
+            for estimate in self.feed(block):
+                yield estimate
+
+
+def read_blocks(stream, block_size=4096):
+    """
+    Yields blocks of bytes from a binary file object until it is exhausted.
+
+    stream     : Readable binary file object, such as sys.stdin.buffer.
+    block_size : Maximum number of bytes per block.
+    """
+    while True:
+        block = stream.read1(block_size) if hasattr(stream, 'read1') \
+                else stream.read(block_size)
+        if not block:
+            return
+        yield block
+
+
+def receive_blocks(address, block_size=4096):
+    """
+    Listens on a TCP address and yields blocks of bytes from the first
+    connection until it is closed.
+
+    address    : (host, port) tuple to listen on.
+    block_size : Maximum number of bytes per block.
+    """
+    with socket.create_server(address) as server:
+        connection, _ = server.accept()
+        with connection:
+            while True:
+                block = connection.recv(block_size)
+                if not block:
+                    return
+                yield block
+
+
+def main():
+    """
+    Run streaming recognition on raw 16-bit PCM from standard input (or a
+    TCP socket), printing one estimate per line as they are made.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('kind', choices=['note', 'chord'])
+    parser.add_argument('-r', '--rate', type=int, default=44100,
+                        help='frame rate of the incoming PCM')
+    parser.add_argument('-c', '--channels', type=int, default=2,
+                        help='number of interleaved channels')
+    parser.add_argument('--hop', type=int, default=None,
+                        help='samples between estimates')
+    parser.add_argument('--history', type=int, default=8,
+                        help='window peaks used per estimate')
+    parser.add_argument('--listen', default=None, metavar='HOST:PORT',
+                        help='read PCM from a TCP connection instead of stdin')
+    args = parser.parse_args()
+
+    recognizer = StreamRecognizer(args.kind, args.rate, args.channels,
+                                  hop_size=args.hop, history=args.history)
+    if args.listen:
+        host, port = args.listen.rsplit(':', 1)
+        blocks = receive_blocks((host, int(port)))
+    else:
+        blocks = read_blocks(sys.stdin.buffer)
+    for estimate in recognizer.run(blocks):
+        print("%.2f %s %.2f" % (estimate['time'], estimate['label'],
+                                estimate['score']), flush=True)
+
+
+if  __name__ =='__main__':
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+"""
+Trains a chord model from a directory of labelled .wav files.
+
+Runs the same feature extraction as Chord over every file on a process
+pool, gathers the exemplars of each label and writes them, together with
+the extraction settings, to an .npz file. Point $CHORD_MODEL at the file
+and Chord (and everything built on it) loads it at startup instead of the
+vectors in a440_train_vector.
+"""
+
+from analysis import Analyzer
+from batch import collect_files
+from Chord import Chord
+from classifier import KNearestNeighbors
+
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import numpy as np
+import os
+import sys
+
+
+def file_label(filename, root):
+    """
+    Returns the label of a training file. Files in a subdirectory of the
+    training directory take the name of the subdirectory, e.g. 'A Major/
+    take1.wav', and files at the top take their own name, as in the bundled
+    data, e.g. 'amajor.wav' becomes 'A Major'.
+    """
+    directory = os.path.relpath(os.path.dirname(filename), root)
+    if directory != os.curdir:
+        return directory.split(os.sep)[0]
+    name = os.path.basename(filename).split('.')[0]
+    for quality in ('major', 'minor'):
+        if name.lower().endswith(quality) and len(name) > len(quality):
+            root_note = name[:-len(quality)].rstrip('_- ')
+            return root_note[0].upper() + root_note[1:] + ' ' + \
+                   quality.capitalize()
+    return name
+
+
+def extract(filename, settings):
+    """
+    Extracts the feature vector of one training file. Used as the process
+    pool task.
+
+    filename : Path to the .wav file.
+    settings : Dictionary of the extraction settings - 'features',
+               'chunk', 'num_peaks' and 'num_notes'.
+
+    Returns the feature vector as np.ndarray, or None if the file could not
+    be read or has too few distinct peaks.
+    """
+    analyzer = Analyzer(chunk=settings['chunk'],
+                        num_peaks=settings['num_peaks'])
+    chord = Chord(filename, analyzer=analyzer, features=settings['features'])
+    try:
+        if settings['features'] == 'peaks':
+            vector = chord.detect_frequency(settings['num_notes'])
+            if len(vector) < settings['num_notes']:
+                return None
+        else:
+            vector = chord.feature_vector
+    except Exception:
+        return None
+    return np.asarray(vector, dtype=float)
+
+
+def train(files, labels, settings, workers=None, average=False):
+    """
+    Builds a classifier from labelled training files.
+
+    files    : List of .wav file paths.
+    labels   : Label of each file, at the same index.
+    settings : Extraction settings, as for extract. Stored with the model.
+    workers  : Number of worker processes. Defaults to the number of CPUs.
+    average  : Whether to keep one exemplar per label, the mean of its
+               files, rather than one per file.
+
+    Returns a tuple of (KNearestNeighbors, list of files that were skipped).
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        chunksize = max(1, len(files) // (4 * (workers or os.cpu_count() or 1)))
+        vectors = list(pool.map(extract, files, [settings] * len(files),
+                                chunksize=chunksize))
+
+    skipped = [f for f, v in zip(files, vectors) if v is None]
+    kept = [(label, v) for label, v in zip(labels, vectors) if v is not None]
+    if not kept:
+        raise ValueError('no usable training files')
+    names = [label for label, _ in kept]
+    features = np.array([v for _, v in kept])
+    if average:
+        names, inverse = np.unique(names, return_inverse=True)
+        sums = np.zeros((len(names), features.shape[1]))
+        np.add.at(sums, inverse, features)
+        features = sums / np.bincount(inverse)[:, np.newaxis]
+    return KNearestNeighbors(features, names, settings=settings), skipped
+
+
+def main():
+    """
+    Run training from the command line, writing the model to the given
+    .npz file.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('directory', help='directory of labelled .wav files')
+    parser.add_argument('-o', '--output', default='chord_model.npz',
+                        help='model file to write')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of worker processes')
+    parser.add_argument('--features', choices=['peaks', 'chroma'],
+                        default='peaks')
+    parser.add_argument('--chunk', type=int, default=2048)
+    parser.add_argument('--peaks', type=int, default=1,
+                        help='spectral peaks per chunk')
+    parser.add_argument('--notes', type=int, default=3,
+                        help='most common frequencies per exemplar')
+    parser.add_argument('--average', action='store_true',
+                        help='keep one averaged exemplar per label')
+    args = parser.parse_args()
+
+    files = collect_files([args.directory])
+    labels = [file_label(f, args.directory) for f in files]
+    settings = {'features': args.features, 'chunk': args.chunk,
+                'num_peaks': args.peaks, 'num_notes': args.notes}
+    model, skipped = train(files, labels, settings, args.workers, args.average)
+    model.save(args.output)
+    for filename in skipped:
+        print("Skipped %s" % filename, file=sys.stderr)
+    print("Wrote %d exemplars of %d labels to %s" %
+          (len(model.labels), len(set(model.labels)), args.output))
+
+
+if  __name__ =='__main__':
+    main()
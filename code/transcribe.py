@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+"""
+Time segmented chord transcription for full length recordings.
+
+Rather than labelling a whole file with one chord, slides a segment over
+the recording and classifies the features within it, merging runs of the
+same chord into a timeline of (start, end, chord, error). The file is read
+in a single pass, one hop at a time, and only the per-chunk features of the
+current segment are kept, so memory does not grow with the length of the
+recording. Segments are described the way the classifier was trained:
+by their most common peak frequencies, or by their chroma.
+"""
+
+from analysis import Analyzer, frame_seconds, map_spectra
+from Chord import ANALYZER, CLASSIFIER, Chord
+
+from collections import deque
+import argparse
+import functools
+import numpy as np
+
+
+def label_segment(peaks, classifier, num_notes=3, features='peaks'):
+    """
+    Classifies the features of one segment.
+
+    peaks      : np.ndarray of per-chunk peaks within the segment, or of
+                 per-chunk chroma when classifying chroma, as from
+                 Chord.chunk_features.
+    classifier : KNearestNeighbors to classify with.
+    num_notes  : Number of most common frequencies to classify.
+    features   : Either 'peaks' or 'chroma', as the classifier was
+                 trained on.
+
+    Returns tuple such that (chord name, distance), or None if the segment
+    has too few distinct peaks to classify (e.g. silence).
+    """
+    vector = Chord.combine_features(peaks, features, num_notes)
+    if vector is None:
+        return None
+    return Chord.classify(vector, classifier)
+
+
+def iter_features(waveform, analyzer, block_frames, features='peaks'):
+    """
+    Yields the per-chunk features of a .wav file, one block of chunks at a
+    time.
+
+    waveform     : WavFile, as from wav_reader.
+    analyzer     : Analyzer holding the chunk size, peaks per chunk, dtype
+                   and workers.
+    block_frames : Number of chunks per block.
+    features     : Either 'peaks' or 'chroma'.
+
+    Yields tuples of (index of the first chunk in the block, np.ndarray with
+    one row of peaks or chroma per chunk).
+    """
+    function = functools.partial(Chord.chunk_features,
+                                 frame_rate=waveform.frame_rate,
+                                 chunk=analyzer.chunk, features=features,
+                                 num_peaks=analyzer.num_peaks)
+    return map_spectra(function, waveform, analyzer.chunk, block_frames,
+                       analyzer.dtype, analyzer.workers)
+
+
+def finish(run):
+    """
+    Turns a run of [start, end, chord, errors] into a timeline entry.
+    """
+    start, end, chord, errors = run
+    return start, end, chord, float(np.mean(errors))
+
+
+def transcribe(source, segment=2.0, hop=None, classifier=CLASSIFIER,
+               analyzer=ANALYZER):
+    """
+    Transcribes the chords of a recording.
+
+    source     : Path, bytes of a .wav file, np.ndarray of samples or
+                 WavFile, as accepted by analysis.Analyzer.
+    segment    : Length in seconds of the context each label is based on.
+    hop        : Seconds between labels. Defaults to the segment length,
+                 so segments do not overlap.
+    classifier : KNearestNeighbors to classify with. Its settings give
+                 the features and number of notes classified.
+    analyzer   : Analyzer holding the chunk size and peaks per chunk, which
+                 should match the ones the classifier was trained with.
+
+    Yields tuples of (start, end, chord, error) with start and end in
+    seconds. Adjacent hops with the same chord are merged, with the error
+    averaged over them. Hops that cannot be classified split the timeline.
+    """
+    features = classifier.settings.get('features', 'peaks')
+    num_notes = classifier.settings.get('num_notes', 3)
+    with analyzer.open(source) as waveform:
+        seconds = frame_seconds(waveform, analyzer.chunk)
+        segment_frames = max(1, int(round(segment / seconds)))
+        hop_frames = segment_frames if hop is None else \
+                     max(1, int(round(hop / seconds)))
+        # Peaks (or chroma) of the most recent segment.
+        peaks = deque(maxlen=segment_frames)
+        # Run of hops with the same label: [start, end, chord, errors].
+        current = None
+        # Features may be found on several threads, but arrive in file
+        # order, so segments are built exactly as in a single pass.
+        for start, block in iter_features(waveform, analyzer, hop_frames,
+                                          features):
+            peaks.extend(block)
+            label = label_segment(np.array(peaks), classifier, num_notes,
+                                  features)
+            begin = start * seconds
+            end = (start + len(block)) * seconds
+            if current is not None and label is not None and \
+               current[2] == label[0]:
+                current[1] = end
+                current[3].append(label[1])
+                continue
+            if current is not None:
+                yield finish(current)
+                current = None
+            if label is not None:
+                current = [begin, end, label[0], [label[1]]]
+        if current is not None:
+            yield finish(current)
+
+
+def main():
+    """
+    Run transcription from the command line, printing one line per chord
+    in the timeline.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('filename')
+    parser.add_argument('-s', '--segment', type=float, default=2.0,
+                        help='seconds of context per label')
+    parser.add_argument('--hop', type=float, default=None,
+                        help='seconds between labels, defaults to the segment')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='threads to split the recording between')
+    args = parser.parse_args()
+
+    analyzer = ANALYZER
+    if args.workers > 1:
+        analyzer = Analyzer(chunk=ANALYZER.chunk, num_peaks=ANALYZER.num_peaks,
+                            workers=args.workers)
+    for start, end, chord, error in transcribe(args.filename, args.segment,
+                                               args.hop, analyzer=analyzer):
+        print("%8.2f %8.2f %s with error %.2f" % (start, end, chord, error))
+
+
+if  __name__ =='__main__':
+    main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+"""
+Memory mapped .wav file reader.
+
+Parses the RIFF header itself and maps the data chunk straight into a NumPy
+array, so that long recordings are paged in from disk as they are analysed
+rather than copied into memory up front. Supports 8, 16, 24 and 32-bit
+integer PCM and 32 and 64-bit float PCM, with any number of channels.
+"""
+
+import io
+import numpy as np
+import struct
+import wave
+
+
+# Format tags from the fmt chunk.
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# Sample dtypes by (is float, bytes per sample). 24-bit samples have no
+# NumPy dtype and are unpacked block by block instead.
+DTYPES = {
+    (False, 1): np.dtype('u1'),
+    (False, 2): np.dtype('<i2'),
+    (False, 4): np.dtype('<i4'),
+    (True, 4): np.dtype('<f4'),
+    (True, 8): np.dtype('<f8'),
+}
+
+
+class WavFile:
+    """
+    Read only, memory mapped view of a .wav file.
+
+    Files are memory mapped, but .wav files already in memory (from_bytes)
+    and bare arrays of samples (from_array) can be wrapped in the same
+    interface.
+    """
+    def __init__(self, filename):
+        """
+        Parses the header of a .wav file and maps its data chunk.
+
+        filename : Path to the .wav file.
+
+        Raises wave.Error if the file is not a supported .wav file.
+        """
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            fmt, data_offset, data_size = WavFile.parse_header(f)
+        shape, dtype = self.set_format(*fmt, data_size=data_size)
+        if self.nframes:
+            self.data = np.memmap(filename, dtype=dtype, mode='r',
+                                  offset=data_offset, shape=shape)
+        else:
+            self.data = np.zeros(shape, dtype=dtype)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Wraps the contents of a .wav file that is already in memory.
+
+        data : bytes of a whole .wav file, header included.
+        """
+        wav = cls.__new__(cls)
+        wav.filename = None
+        fmt, data_offset, data_size = WavFile.parse_header(io.BytesIO(data))
+        shape, dtype = wav.set_format(*fmt, data_size=data_size)
+        wav.data = np.frombuffer(data, dtype=dtype, count=int(np.prod(shape)),
+                                 offset=data_offset).reshape(shape)
+        return wav
+
+    @classmethod
+    def from_array(cls, samples, frame_rate, channels=1):
+        """
+        Wraps an array of samples.
+
+        samples    : One dimensional np.ndarray of samples, with channels
+                     interleaved. Integer arrays of a type a .wav file can
+                     hold are used as they are, anything else as floats.
+        frame_rate : Frame rate of the samples - frames / second.
+        channels   : Number of interleaved channels.
+        """
+        samples = np.asarray(samples).ravel()
+        if samples.dtype not in DTYPES.values():
+            samples = samples.astype('<f8')
+        wav = cls.__new__(cls)
+        wav.filename = None
+        wav.channels = channels
+        wav.frame_rate = frame_rate
+        wav.sample_width = samples.dtype.itemsize
+        wav.is_float = samples.dtype.kind == 'f'
+        wav.nframes = len(samples) // channels
+        wav.data = samples[:wav.nframes * channels]
+        return wav
+
+    def set_format(self, format_tag, channels, frame_rate, bits, data_size):
+        """
+        Sets the format attributes from the values in a fmt chunk.
+
+        Returns the (shape, dtype) of the data chunk as an array.
+        """
+        self.channels = channels
+        self.frame_rate = frame_rate
+        # Bytes per sample, as returned by wave's getsampwidth.
+        self.sample_width = (bits + 7) // 8
+        self.is_float = format_tag == WAVE_FORMAT_IEEE_FLOAT
+        if (self.is_float, self.sample_width) not in DTYPES and \
+           self.sample_width != 3:
+            raise wave.Error('unsupported sample format: %d-bit %s' %
+                             (bits, 'float' if self.is_float else 'PCM'))
+
+        frame_size = self.channels * self.sample_width
+        # Number of frames - one sample for every channel.
+        self.nframes = data_size // frame_size
+        if self.sample_width == 3:
+            return (self.nframes * self.channels, 3), np.dtype('u1')
+        return (self.nframes * self.channels,), \
+               DTYPES[(self.is_float, self.sample_width)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        """
+        Returns the number of interleaved samples in the file.
+        """
+        return self.nframes * self.channels
+
+    def close(self):
+        """
+        Releases the memory map. The file itself is unmapped as soon as no
+        arrays returned by read are left referring to it.
+        """
+        self.data = np.zeros((0,) + self.data.shape[1:], dtype=self.data.dtype)
+
+    @staticmethod
+    def parse_header(f):
+        """
+        Walks the RIFF chunks of an open file for the fmt and data chunks.
+
+        f : Binary file object positioned at the start of the file.
+
+        Returns a tuple of ((format tag, channels, frame rate, bits per
+        sample), data offset, data size). The data size is clipped to the
+        end of the file, so truncated files can still be read.
+        """
+        riff = f.read(12)
+        if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:] != b'WAVE':
+            raise wave.Error('file does not start with RIFF id')
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise wave.Error('data chunk not found')
+            name, size = struct.unpack('<4sI', header)
+            if name == b'fmt ':
+                chunk = f.read(size)
+                if len(chunk) < 16:
+                    raise wave.Error('fmt chunk too short')
+                format_tag, channels, frame_rate, _, _, bits = \
+                    struct.unpack('<HHIIHH', chunk[:16])
+                if format_tag == WAVE_FORMAT_EXTENSIBLE and len(chunk) >= 26:
+                    # The real format tag leads the sub format GUID.
+                    format_tag = struct.unpack('<H', chunk[24:26])[0]
+                if format_tag not in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT):
+                    raise wave.Error('unknown format: %d' % format_tag)
+                fmt = (format_tag, channels, frame_rate, bits)
+            elif name == b'data':
+                if fmt is None:
+                    raise wave.Error('data chunk before fmt chunk')
+                offset = f.tell()
+                end = f.seek(0, 2)
+                return fmt, offset, min(size, end - offset)
+            else:
+                f.seek(size, 1)
+            # Chunks are padded to an even number of bytes.
+            if size % 2:
+                f.seek(1, 1)
+
+    def read(self, start=0, stop=None):
+        """
+        Returns a range of interleaved samples.
+
+        For 8, 16 and 32-bit integer and float PCM this is a view of the
+        memory map rather than a copy. 8-bit samples are offset to be
+        centered on zero and 24-bit samples are unpacked to int32, which
+        does copy the range.
+
+        start : Index of the first interleaved sample.
+        stop  : Index one past the last interleaved sample. Defaults to the
+                end of the file.
+        """
+        samples = self.data[start:stop]
+        if self.sample_width == 3:
+            # Sign extend the little endian bytes into the top of an int32.
+            padded = np.zeros((len(samples), 4), dtype='u1')
+            padded[:, 1:] = samples
+            return padded.view('<i4').ravel() >> 8
+        if self.sample_width == 1:
+            return samples.astype(np.int16) - 128
+        return samples
+
+    def mono(self, start=0, stop=None):
+        """
+        Returns a range of frames with every channel averaged together.
+
+        start : Index of the first frame.
+        stop  : Index one past the last frame. Defaults to the end of the
+                file.
+
+        Returns a one dimensional float np.ndarray.
+        """
+        stop = self.nframes if stop is None else min(stop, self.nframes)
+        samples = self.read(start * self.channels, stop * self.channels)
+        return samples.reshape(-1, self.channels).mean(axis=1)
@@ -1,46 +1,315 @@
+#!/usr/bin/env python3
+
+"""
+Synthetic struck string notes and chords, by modal summation.
+
+A string fixed at both ends is struck by a hammer, and its motion is the
+sum of its normal modes, each a sinusoid in time with an amplitude given
+by the Fourier transform of the initial velocity. Rather than adding a
+full length sine for every mode in turn, every mode is evaluated at once
+as one (modes, samples) matrix product per block of samples, so memory
+stays bounded however long the tone. Corpora of labelled notes and
+chords are written as .wav files on a process pool.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import functools
 import numpy as np
+import os
+import re
+import wave
+
 Fs = 44100 #Frequency to sample the sound at
-c = 261.6 #m/s - Designed to get middle C on a string with a 0.5m length
-inharm = 0 #(m/s)^2 - inharmonicity factor based on adding a u_xxxx term
+L = 0.5 #m - length of the string
 N = 10000 #Number of elements along the length of the string
+inharm = 0 #Inharmonicity coefficient B of a stiff string, f_n = n f sqrt(1 + B n^2)
 damping = 0.02 #A frequency-dependent damping "fudge factor"
 total_t0 = 0.5 #A frequency-agnostic decay with timescale t0 (in seconds)
 delta = .001 # width of hammer
 frac = 3 # hammer centered at position 1/frac of total length
-x=np.linspace(0,0.5,N)
-u0= np.zeros(x.shape)
-du0 = np.cos(2*np.pi*(x-0.5/frac)/delta) + .5
-# Go through and grab frequencies that match threshold
-for i in range(len(x)):
-    if (x[i] < (.5/frac - (delta/2)) or x[i]> (0.5/frac + (delta/2))):
-        du0[i] = 0
-
-
-x_full = x[::-1]s
-u0_full = u0[::-1]
-du0_full = du0[::-1]
-# x_full = [-np.fliplr(x),x]
-#u0_full = [-np.fliplr(u0),u0]
-#du0_full = [-np.fliplr(du0),du0]
-N = np.array(N)
-k_full = [np.arange(N),np.arange(-N+1,-1+1)]*2#*np.pi
-
-pos_ft = np.fft.fft(u0_full)
-vel_ft = np.fft.fft(du0_full)
-try:
-t_start = np.arange(0,0.1+1/Fs, 1/Fs)
-except ZeroDivisionError:
-pass
-
-t = np.arange(0, 3+1/Fs, 1/Fs)
-y=np.zeros(t.shape)
-
-for i in np.nditer(k_full):
-    if (i * c > 50) and (i * c < 150000):
-        w = k_full(i) * c + k_full(i) ^ 2 * inharm
-        y = y + (abs(vel_ft(i)) * np.sin(w * t) / (w)) * np.exp(-k_full(i) * damping * t)
-        y = y + (abs(pos_ft(i)) * np.cos(w * t)) * np.exp(-k_full(i) * damping * t)
-
-y = y * np.exp(-t/total_t0)
-y = y / max(abs(y))*0.8
-audiowrite('middle_c.wav',[zeros(size(t_start)),y],Fs)
+lead = 0.1 # seconds of silence before the note is struck
+
+# Note names within an octave, starting from C.
+NOTE_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+# Semitones above the root of the notes of each chord quality.
+CHORDS = {
+    'Major': [0, 4, 7],
+    'Minor': [0, 3, 7],
+    'Diminished': [0, 3, 6],
+    'Augmented': [0, 4, 8],
+    'Major 7': [0, 4, 7, 11],
+    'Minor 7': [0, 3, 7, 10],
+    'Dominant 7': [0, 4, 7, 10],
+}
+
+
+@functools.lru_cache(maxsize=None)
+def hammer_modes(elements=N, width=delta, position=frac):
+    """
+    Mode amplitudes of a string struck by a hammer.
+
+    The string starts at rest with a raised cosine velocity under the
+    hammer. Extending it to an odd function over twice its length makes it
+    periodic, so the Fourier transform gives the amplitude of every mode.
+
+    elements : Number of elements along the length of the string.
+    width    : Width of the hammer, in m.
+    position : The hammer is centered at 1/position of the length.
+
+    Returns a tuple of (position amplitudes, velocity amplitudes), indexed
+    by mode number.
+    """
+    x = np.linspace(0, L, elements)
+    u0 = np.zeros(x.shape)
+    du0 = np.cos(2*np.pi*(x - L/position)/width) + .5
+    # Only the part of the string under the hammer moves.
+    du0[np.abs(x - L/position) > width/2] = 0
+
+    u0_full = np.concatenate((-u0[::-1], u0))
+    du0_full = np.concatenate((-du0[::-1], du0))
+    pos_ft = np.abs(np.fft.fft(u0_full))[:elements]
+    vel_ft = np.abs(np.fft.fft(du0_full))[:elements]
+    return pos_ft, vel_ft
+
+
+def string_tone(frequency, duration=3.0, fs=Fs, inharmonicity=inharm,
+                damping=damping, decay=total_t0, width=delta, position=frac,
+                block=4096):
+    """
+    Synthesizes the tone of a struck string.
+
+    frequency     : Fundamental frequency in Hertz (Hz).
+    duration      : Length of the tone in seconds.
+    fs            : Sample rate.
+    inharmonicity : Stiffness coefficient B; mode n sounds at
+                    n frequency sqrt(1 + B n^2).
+    damping       : Decay rate per mode number, so higher modes die first.
+    decay         : Timescale in seconds of the decay of every mode.
+    width         : Width of the hammer, in m.
+    position      : The hammer is centered at 1/position of the length.
+    block         : Number of samples evaluated at once.
+
+    Returns np.ndarray of samples, not normalized.
+    """
+    pos_ft, vel_ft = hammer_modes(N, width, position)
+    n = np.arange(1, len(pos_ft))
+    mode_frequency = n * frequency * np.sqrt(1 + inharmonicity * n**2)
+    # Keep audible modes below the Nyquist frequency, so nothing aliases.
+    audible = (mode_frequency > 20) & (mode_frequency < fs / 2.)
+    n = n[audible]
+    w = 2*np.pi*mode_frequency[audible]
+    rate = n * damping + 1. / decay
+
+    # Each mode is the real part of coefficient * exp(pole * t), so a block
+    # of every mode is the block starting at zero, scaled by where the
+    # block starts. The block starting at zero is only computed once.
+    pole = -rate + 1j*w
+    coefficient = pos_ft[n] - 1j*vel_ft[n]/w
+    basis = np.exp(np.outer(pole, np.arange(block) / float(fs)))
+
+    y = np.zeros(int(round(duration * fs)))
+    for start in range(0, len(y), block):
+        stop = min(start + block, len(y))
+        weights = coefficient * np.exp(pole * start / float(fs))
+        y[start:stop] = (weights @ basis[:, :stop - start]).real
+    return y
+
+
+def note_frequency(name, tuning=440.0):
+    """
+    Returns the equal tempered frequency of a note such as 'C4', 'C#4',
+    'Db4' or 'CS4' (as in a440_dict), with A4 at the tuning frequency.
+    """
+    match = re.fullmatch(r'([A-Ga-g])([#Ss]|b|N)?(-?\d+)', name)
+    if match is None:
+        raise ValueError('not a note: %r' % name)
+    letter, accidental, octave = match.groups()
+    semitone = NOTE_NAMES.index(letter.upper())
+    if accidental in ('#', 'S', 's'):
+        semitone += 1
+    elif accidental == 'b':
+        semitone -= 1
+    # Semitones above A4.
+    distance = semitone - 9 + 12 * (int(octave) - 4)
+    return tuning * 2 ** (distance / 12.)
+
+
+def pitch_name(name):
+    """
+    Returns a note name in the form of a440_dict, e.g. 'CS4' for 'C#4' or
+    'Db4', as Note reports it.
+    """
+    semitone = round(12 * np.log2(note_frequency(name) / 440.)) + 9 + 48
+    return '%s%s%d' % (NOTE_NAMES[semitone % 12][0],
+                       'S' if semitone % 12 in (1, 3, 6, 8, 10) else 'N',
+                       semitone // 12)
+
+
+def chord_notes(label, octave=4):
+    """
+    Returns the notes of a chord label such as 'C Major' or 'F# Minor 7',
+    with the root in the given octave.
+    """
+    root, quality = label.split(' ', 1)
+    semitone = NOTE_NAMES.index(root[0].upper()) + \
+               {'#': 1, 'S': 1, 'b': -1}.get(root[1:], 0)
+    notes = []
+    for step in CHORDS[quality]:
+        index = semitone + step
+        notes.append('%s%d' % (NOTE_NAMES[index % 12], octave + index // 12))
+    return notes
+
+
+def render(notes, tuning=440.0, duration=3.0, fs=Fs, detune=0.0, **options):
+    """
+    Synthesizes notes struck together, as in the original script: a short
+    silence followed by the tone, scaled to a peak of 0.8.
+
+    notes    : List of note names, as for note_frequency.
+    tuning   : Frequency of A4 in Hertz (Hz).
+    duration : Length of the tone in seconds.
+    fs       : Sample rate.
+    detune   : Offset of every note in cents.
+    options  : Passed on to string_tone.
+
+    Returns np.ndarray of samples between -1 and 1.
+    """
+    y = sum(string_tone(note_frequency(note, tuning) * 2 ** (detune / 1200.),
+                        duration, fs, **options) for note in notes)
+    y = np.concatenate((np.zeros(int(round(lead * fs))), y))
+    peak = np.max(np.abs(y))
+    return y / peak * 0.8 if peak else y
+
+
+def write_wav(path, samples, fs=Fs, channels=1):
+    """
+    Writes samples between -1 and 1 to a 16-bit .wav file, copying them to
+    every channel.
+    """
+    pcm = np.round(np.clip(samples, -1, 1) * 32767).astype('<i2')
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(channels)
+        f.setsampwidth(2)
+        f.setframerate(fs)
+        f.writeframes(np.repeat(pcm, channels).tobytes())
+
+
+def render_file(path, notes, channels=1, **options):
+    """
+    Renders notes to a .wav file. Used as the process pool task.
+
+    Returns the path written.
+    """
+    write_wav(path, render(notes, **options), options.get('fs', Fs), channels)
+    return path
+
+
+def build_corpus(output, labels, takes=1, seed=0, workers=None, channels=1,
+                 **options):
+    """
+    Writes a labelled corpus, one directory per label, in parallel.
+
+    Every take after the first varies the hammer position, damping, decay
+    and tuning slightly, drawn from a generator seeded by the seed and the
+    take, so the same arguments always give the same files.
+
+    output   : Directory to write to.
+    labels   : Dictionary of label to list of note names.
+    takes    : Number of files per label.
+    seed     : Seed of the variations.
+    workers  : Number of worker processes. Defaults to the number of CPUs.
+    channels : Number of channels to write.
+    options  : Passed on to render.
+
+    Returns the list of files written.
+    """
+    tasks = []
+    for label, notes in labels.items():
+        directory = os.path.join(output, label)
+        os.makedirs(directory, exist_ok=True)
+        for take in range(takes):
+            settings = dict(options)
+            if take:
+                rng = np.random.default_rng([seed, take])
+                settings['position'] = frac * rng.uniform(0.8, 1.25)
+                settings['damping'] = options.get('damping', damping) * \
+                                      rng.uniform(0.5, 2)
+                settings['decay'] = options.get('decay', total_t0) * \
+                                    rng.uniform(0.5, 2)
+                settings['detune'] = rng.uniform(-15, 15)
+            path = os.path.join(directory, 'take%03d.wav' % take)
+            tasks.append((path, notes, settings))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(render_file, path, notes, channels, **settings)
+                   for path, notes, settings in tasks]
+        return [future.result() for future in futures]
+
+
+def main():
+    """
+    Write a corpus from the command line. With no notes or chords, writes
+    middle C to middle_c.wav, as the original script did.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('output', nargs='?', default='.',
+                        help='directory to write to')
+    parser.add_argument('--notes', nargs='*', default=[],
+                        help="notes such as C4 or F#2, or 'all'")
+    parser.add_argument('--chords', nargs='*', default=[],
+                        help="chords such as 'C Major', or 'all'")
+    parser.add_argument('--octaves', default='1-7',
+                        help="octaves for 'all' notes, e.g. 1-7")
+    parser.add_argument('--octave', type=int, default=4,
+                        help='octave of chord roots')
+    parser.add_argument('--takes', type=int, default=1,
+                        help='files per label, varied slightly')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tuning', type=float, default=440.0,
+                        help='frequency of A4 in Hz')
+    parser.add_argument('--inharmonicity', type=float, default=inharm)
+    parser.add_argument('--damping', type=float, default=damping)
+    parser.add_argument('--decay', type=float, default=total_t0)
+    parser.add_argument('--duration', type=float, default=3.0)
+    parser.add_argument('--channels', type=int, default=1)
+    parser.add_argument('-j', '--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    options = {'tuning': args.tuning, 'inharmonicity': args.inharmonicity,
+               'damping': args.damping, 'decay': args.decay,
+               'duration': args.duration}
+    if not args.notes and not args.chords:
+        os.makedirs(args.output, exist_ok=True)
+        path = render_file(os.path.join(args.output, 'middle_c.wav'), ['C4'],
+                           args.channels, **options)
+        print("Wrote %s" % path)
+        return
+
+    labels = {}
+    for note in args.notes:
+        if note == 'all':
+            low, high = map(int, args.octaves.split('-'))
+            for octave in range(low, high + 1):
+                for name in NOTE_NAMES:
+                    labels[pitch_name(name + str(octave))] = \
+                        [name + str(octave)]
+        else:
+            labels[pitch_name(note)] = [note]
+    for chord in args.chords:
+        if chord == 'all':
+            for root in NOTE_NAMES:
+                for quality in ('Major', 'Minor'):
+                    label = '%s %s' % (root, quality)
+                    labels[label] = chord_notes(label, args.octave)
+        else:
+            labels[chord] = chord_notes(chord, args.octave)
+
+    files = build_corpus(args.output, labels, args.takes, args.seed,
+                         args.workers, args.channels, **options)
+    print("Wrote %d files of %d labels to %s" % (len(files), len(labels),
+                                                 args.output))
+
+
+if  __name__ =='__main__':
+    main()